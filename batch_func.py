@@ -0,0 +1,167 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+import stats_func
+
+INPUT_EXTS = (".pdf", ".tif", ".tiff")
+
+
+def is_input(filename):
+    name, ext = os.path.splitext(filename)
+    return ext.lower() in INPUT_EXTS
+
+
+# expand input globs, directories and list files to a sorted list of input files
+def find_inputs(patterns, listfile=None):
+    if listfile:
+        with open(listfile) as fh:
+            for line in fh:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line)
+
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for filename in sorted(os.listdir(pattern)):
+                fname = os.path.join(pattern, filename)
+                if os.path.isfile(fname) and is_input(filename):
+                    inputs.append(fname)
+        elif glob.has_magic(pattern):
+            for fname in sorted(glob.glob(pattern)):
+                if os.path.isfile(fname) and is_input(fname):
+                    inputs.append(fname)
+        else:
+            inputs.append(pattern)
+
+    # drop duplicates, keeping the first occurrence
+    seen = set()
+    files = []
+    for fname in inputs:
+        key = os.path.realpath(fname)
+        if key not in seen:
+            seen.add(key)
+            files.append(fname)
+
+    return files
+
+
+# a thread count (a number or ALL_CPUS) capped at share, None stays unset
+def cap_threads(threads, share):
+    if threads is None:
+        return None
+    if threads == "ALL_CPUS" or int(threads) > share:
+        return share
+    return threads
+
+
+# options for one of jobs workers, the jpeg, warp and gdal threads are capped
+# at the worker's share of the cpus so the workers don't oversubscribe the machine
+def worker_options(options, jobs):
+    share = max(1, (os.cpu_count() or 1) // jobs)
+
+    co = []
+    for opt in options.creation_options:
+        if opt.startswith("NUM_THREADS="):
+            opt = "NUM_THREADS=%s" % cap_threads(opt.split("=", 1)[1], share)
+        co.append(opt)
+
+    return options._replace(jpeg_workers=cap_threads(options.jpeg_workers, share),
+                            warp_threads=cap_threads(options.warp_threads, share),
+                            num_threads=cap_threads(options.num_threads, share), creation_options=tuple(co))
+
+
+# convert a single file in a worker process, returns (input, error) with error
+# None once the file is converted
+def convert_one(job):
+    ifile, options = job
+
+    # imported here so the worker keeps gdal and the pipeline loaded between files
+    import pdf2kmz
+
+    try:
+        pdf2kmz.convert(ifile, options)
+        err = None
+    except KeyboardInterrupt:
+        raise
+    except pdf2kmz.ConvertError as e:
+        err = str(e)
+    except BaseException as e:
+        err = "%s: %s" % (type(e).__name__, e)
+
+    return ifile, err
+
+
+# stats report a worker wrote for a file, or a bare failure record if it wrote none
+def read_stats(sfile, ifile, err):
+    try:
+        with open(sfile) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        report = {"input": ifile, "status": "failed"}
+        if err:
+            report["error"] = err
+        return report
+
+
+# convert a list of files on a pool of worker processes, with options.stats the
+# per file stats reports are gathered into one report
+def run_batch(inputs, options, jobs):
+    import multiprocessing
+
+    jobs = max(1, min(jobs, len(inputs)))
+    sfile = options.stats
+    options = worker_options(options, jobs)
+
+    if options.verbose:
+        print("Converting %d files with %d workers" % (len(inputs), jobs))
+
+    tasks = [(ifile, options) for ifile in inputs]
+    if sfile:
+        statsd = tempfile.mkdtemp(prefix="stats.")
+        sfiles = {}
+        for i, ifile in enumerate(inputs):
+            sfiles[ifile] = os.path.join(statsd, "%d.json" % i)
+        tasks = [(ifile, options._replace(stats=sfiles[ifile])) for ifile in inputs]
+
+    failed = []
+    done = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for ifile, err in pool.imap_unordered(convert_one, tasks):
+            done += 1
+            if err is None:
+                print("[%d/%d] ok: %s" % (done, len(inputs), ifile))
+            else:
+                failed.append((ifile, err))
+                print("[%d/%d] FAILED: %s (%s)" % (done, len(inputs), ifile, err))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    if sfile:
+        reports = []
+        errors = dict(failed)
+        for ifile in inputs:
+            report = read_stats(sfiles[ifile], ifile, errors.get(ifile))
+            if ifile in errors:
+                report["status"] = "failed"
+            reports.append(report)
+        shutil.rmtree(statsd, ignore_errors=True)
+        stats_func.write(stats_func.aggregate(reports), sfile)
+
+    print("")
+    print("%d of %d files converted, %d failed" % (len(inputs) - len(failed), len(inputs), len(failed)))
+    for ifile, err in sorted(failed):
+        print("  failed: %s" % ifile)
+
+    if failed:
+        return 1
+    else:
+        return 0
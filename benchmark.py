@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import datetime
+import getopt
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal
+from osgeo import osr
+
+import map_func
+import pdf2kmz
+import tile_func
+
+# centre and pixel size of the synthetic maps in each supported crs
+CRS_ORIGINS = {
+    4326: (145.0, -37.5, 0.00002),
+    3857: (16141000.0, -4509000.0, 2.5),
+    28355: (320000.0, 5820000.0, 2.0),
+    26910: (480000.0, 5010000.0, 2.0),
+}
+
+# fraction of the page taken by the white margin around the map
+MARGIN = 0.06
+
+# rows written at a time when generating a map
+STRIP = 512
+
+# modules the command line must not load when it has no conversion to do
+HEAVY_MODULES = ["osgeo", "numpy", "PIL", "multiprocessing", "genkml_func", "genkmz_func", "map_func", "tile_func"]
+
+# invocations of the command line that return before converting anything, the
+# input file is filled in with a pdf whose kmz already exists
+STARTUP_VARIANTS = [
+    ("help", ["-h"]),
+    ("option_error", ["-q", "high"]),
+    ("output_exists", ["-i", None]),
+]
+
+# script importing pdf2kmz and running main, prints the heavy modules it loaded
+STARTUP_PROBE = """
+import contextlib, io, json, sys
+sys.path.insert(0, sys.argv[1])
+import pdf2kmz
+with contextlib.redirect_stdout(io.StringIO()):
+    pdf2kmz.main(["pdf2kmz.py"] + sys.argv[3:])
+print(json.dumps([m for m in json.loads(sys.argv[2]) if m in sys.modules]))
+"""
+
+# argument sets of the whole conversion timed for each map
+MAIN_VARIANTS = [
+    ("autoclip", ["-c"]),
+    ("coarse_clip", ["--coarse-clip"]),
+    ("neatline", ["-n"]),
+    ("fused", ["-c", "-F"]),
+]
+
+# warp settings timed against each other on every map, the warp defaults of
+# pdf2kmz are chosen from these
+WARP_VARIANTS = [
+    ("threads_1", {"warp_threads": 1}),
+    ("threads_2", {"warp_threads": 2}),
+    ("threads_all_cpus", {"warp_threads": "ALL_CPUS"}),
+    ("memory_gdal", {"warp_memory": None}),
+    ("memory_256", {"warp_memory": 256}),
+    ("memory_1024", {"warp_memory": 1024}),
+    ("error_0", {"warp_error": 0}),
+    ("error_gdal", {"warp_error": None}),
+    ("error_0.5", {"warp_error": 0.5}),
+]
+
+# pdf band counts whose rendering must be identical to a single pass, 7 leaves a
+# short last band
+BAND_CHECKS = [2, 3, 7]
+
+
+# pixel corners of the map frame inside the margin
+def map_frame(xsize, ysize):
+    mx = int(xsize * MARGIN)
+    my = int(ysize * MARGIN)
+    return mx, my, xsize - mx, ysize - my
+
+
+# neatline of the map frame in the georeferenced coordinates of gt
+def neatline_wkt(gt, xsize, ysize):
+    x0, y0, x1, y1 = map_frame(xsize, ysize)
+    points = []
+    for px, py in ((x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)):
+        points.append("%.17g %.17g" % (gt[0] + px * gt[1] + py * gt[2], gt[3] + px * gt[4] + py * gt[5]))
+
+    return "POLYGON ((%s))" % ", ".join(points)
+
+
+# synthetic rgb map: a shaded map with gridlines and a frame inside a white margin,
+# dark legend boxes below the map and, with border, black corners as left by
+# warping a scanned page
+def make_tif(ofile, xsize, ysize, epsg, border=False):
+    cx, cy, res = CRS_ORIGINS[epsg]
+    gt = (cx - xsize / 2.0 * res, res, 0.0, cy + ysize / 2.0 * res, 0.0, -res)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+
+    drv = gdal.GetDriverByName("GTiff")
+    ds = drv.Create(ofile, xsize, ysize, 3, gdal.GDT_Byte, ["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"])
+    ds.SetGeoTransform(gt)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetMetadataItem("NEATLINE", neatline_wkt(gt, xsize, ysize))
+
+    x0, y0, x1, y1 = map_frame(xsize, ysize)
+    grid = max(32, min(x1 - x0, y1 - y0) // 8)
+    line = max(2, min(xsize, ysize) // 1000)
+    corner = min(x0, y0)
+
+    x = np.arange(xsize)[None, :]
+    for yoff in range(0, ysize, STRIP):
+        rows = min(STRIP, ysize - yoff)
+        y = np.arange(yoff, yoff + rows)[:, None]
+
+        inside = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+        shade = 190 + 40 * np.sin(x / 37.0) * np.cos(y / 53.0)
+
+        rgb = [np.full((rows, xsize), 255, dtype=np.uint8) for i in range(3)]
+        for i, tint in enumerate((0, 15, -20)):
+            band = np.clip(shade + tint, 0, 255).astype(np.uint8)
+            rgb[i][inside] = band[inside]
+
+        gridlines = inside & ((((x - x0) % grid) < line) | (((y - y0) % grid) < line))
+        frame = inside & ((x < x0 + 2 * line) | (x >= x1 - 2 * line) | (y < y0 + 2 * line) | (y >= y1 - 2 * line))
+        legend = (y >= y1 + (ysize - y1) // 3) & (y < ysize - (ysize - y1) // 3) & (((x - x0) % (grid // 2)) < grid // 4) & (x >= x0) & (x < x1)
+        dark = gridlines | frame | legend
+
+        if border:
+            dark = dark | (x + y < corner) | ((xsize - 1 - x) + y < corner) | (x + (ysize - 1 - y) < corner) | ((xsize - 1 - x) + (ysize - 1 - y) < corner)
+
+        for band in rgb:
+            band[dark & inside] = 40
+            band[dark & ~inside] = 0
+
+        for i, band in enumerate(rgb):
+            ds.GetRasterBand(i + 1).WriteArray(band, 0, yoff)
+
+    ds.FlushCache()
+    del ds
+
+
+# synthetic geopdf of a synthetic map, rendered back at the default dpi it has the same size
+def make_pdf(ofile, tfile):
+    src = gdal.Open(tfile)
+    gt = src.GetGeoTransform()
+    opt = gdal.TranslateOptions(format="PDF", creationOptions=["DPI=%d" % pdf2kmz.GDAL_PDF_DPI, "COMPRESS=DEFLATE",
+                                                               "NEATLINE=%s" % neatline_wkt(gt, src.RasterXSize, src.RasterYSize)])
+    gdal.Translate(ofile, src, options=opt)
+    del src
+
+
+def time_call(func, *args):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = func(*args)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def add_timing(timings, name, wall, cpu):
+    entry = timings.setdefault(name, {"wall": [], "cpu": []})
+    entry["wall"].append(wall)
+    entry["cpu"].append(cpu)
+
+
+# minimum and median of the repeated timings
+def summarise(timings):
+    for entry in timings.values():
+        for key in ("wall", "cpu"):
+            runs = sorted(entry[key])
+            entry[key + "_min"] = runs[0]
+            entry[key + "_median"] = runs[len(runs) // 2]
+
+    return timings
+
+
+# size and per band checksums of a raster
+def checksums(fname):
+    ds = gdal.Open(fname)
+    sums = {"size": [ds.RasterXSize, ds.RasterYSize],
+            "bands": [ds.GetRasterBand(i + 1).Checksum() for i in range(ds.RasterCount)]}
+    del ds
+    return sums
+
+
+# render the pdf in a single pass and as bands, every banded rendering must
+# match the single pass, the rendering without overlap shows whether it is needed
+def check_bands(ifile, tempd):
+    options = pdf2kmz.Options()
+
+    single = tempd + os.sep + "single.tif"
+    pdf2kmz.pdf2tif(ifile, single, options)
+    expected = checksums(single)
+    os.remove(single)
+
+    check = {"single": expected, "bands": {}, "ok": True}
+    for bands in BAND_CHECKS:
+        banded = tempd + os.sep + "bands%d.tif" % bands
+        pdf2kmz.pdf2tif(ifile, banded, options._replace(pdf_bands=bands))
+        sums = checksums(banded)
+        os.remove(banded)
+        check["bands"][str(bands)] = sums
+        if sums != expected:
+            check["ok"] = False
+
+    overlap = pdf2kmz.PDF_BAND_OVERLAP
+    pdf2kmz.PDF_BAND_OVERLAP = 0
+    try:
+        banded = tempd + os.sep + "no_overlap.tif"
+        pdf2kmz.pdf2tif(ifile, banded, options._replace(pdf_bands=BAND_CHECKS[-1]))
+        check["overlap_needed"] = checksums(banded) != expected
+        os.remove(banded)
+    finally:
+        pdf2kmz.PDF_BAND_OVERLAP = overlap
+
+    return check
+
+
+# run every pipeline stage once on its own, in the order the conversion does
+def run_stages(ifile, tempd, timings):
+    def stage(name, func, *args):
+        result, wall, cpu = time_call(func, *args)
+        add_timing(timings, name, wall, cpu)
+        return result
+
+    options = pdf2kmz.Options(scale=50)
+
+    name, ext = os.path.splitext(os.path.basename(ifile))
+    if ext.lower() == ".pdf":
+        tif = tempd + os.sep + name + ".tif"
+        stage("pdf2tif", pdf2kmz.pdf2tif, ifile, tif, options)
+    else:
+        tif = ifile
+
+    clipped = tempd + os.sep + "clipped.tif"
+    extent = stage("find_map_extent", map_func.find_map_extent, tif, options.clip_offset)
+    stage("find_map_extent_coarse", map_func.find_map_extent, tif, options.clip_offset, True)
+    stage("clip", pdf2kmz.clip, tif, clipped, extent[0], extent[1], extent[2], extent[3], False, options)
+    stage("clipbycutline", pdf2kmz.clipbycutline, tif, tempd + os.sep + "neatline.tif", tempd, None, options)
+
+    warped = tempd + os.sep + "warped.tif"
+    stage("gdalwarp", pdf2kmz.gdalwarp, clipped, warped, options)
+    for name, settings in WARP_VARIANTS:
+        variant = tempd + os.sep + "warped_%s.tif" % name
+        stage("gdalwarp_" + name, pdf2kmz.gdalwarp, clipped, variant, options._replace(**settings))
+        os.remove(variant)
+
+    bordered = tempd + os.sep + "border.tif"
+    xoff, yoff, xsize, ysize, nx, ny = stage("find_map_trim", map_func.find_map_trim, warped, 0, options.border_offset)
+    stage("clip_border", pdf2kmz.clip, warped, bordered, xoff, yoff, xsize, ysize, False, options)
+    stage("gdalscale", pdf2kmz.gdalscale, bordered, tempd + os.sep + "rescaled.tif", options)
+
+    src = gdal.Open(bordered)
+    candidates = tile_func.plan_tiles(src.RasterXSize, src.RasterYSize, options.max_tiles, options.max_tile_res)
+    del src
+    if len(candidates) == 0:
+        return
+
+    path = tempd + os.sep + "tiled"
+    os.mkdir(path)
+    ts = candidates[0]
+    stage("tif2kmz", pdf2kmz.tif2kmz, bordered, tempd + os.sep + "stages.kmz", path, ts[3], ts[4], options)
+
+
+# fastest value of each warp setting in the sweep, by median wall time
+def fastest_warps(stages):
+    fastest = {}
+    for name, settings in WARP_VARIANTS:
+        for key, value in settings.items():
+            wall = stages["gdalwarp_" + name]["wall_median"]
+            if key not in fastest or wall < fastest[key]["wall_median"]:
+                fastest[key] = {"value": value, "wall_median": wall}
+
+    return fastest
+
+
+# run the whole conversion through main, returns its stats report
+def run_main(ifile, tempd, args, timings, name):
+    sfile = tempd + os.sep + "stats.json"
+    argv = ["pdf2kmz.py", "-i", ifile, "-o", tempd, "-f", "-t", tempd, "--stats", sfile] + args
+
+    rc, wall, cpu = time_call(pdf2kmz.main, argv)
+    if rc != 0:
+        raise RuntimeError("pdf2kmz %s failed on %s" % (" ".join(args), ifile))
+    add_timing(timings, name, wall, cpu)
+
+    with open(sfile) as fh:
+        return json.load(fh)
+
+
+# time the command line on the paths that do no conversion, against the startup
+# of a bare interpreter, and check they load none of the heavy modules
+def run_startup(tempd, repeat, budget):
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), "pdf2kmz.py")
+    ifile = tempd + os.sep + "startup.pdf"
+    for fname in (ifile, tempd + os.sep + "startup.kmz"):
+        open(fname, 'w').close()
+
+    def wall(cmd):
+        runs = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            runs.append(time.perf_counter() - start)
+        return min(runs)
+
+    baseline = wall([sys.executable, "-c", "pass"])
+    startup = {"baseline": baseline, "budget": budget, "cases": {}}
+    for name, variant in STARTUP_VARIANTS:
+        args = [ifile if a is None else a for a in variant]
+        elapsed = wall([sys.executable, script] + args)
+        probe = subprocess.check_output([sys.executable, "-c", STARTUP_PROBE, os.path.dirname(script),
+                                         json.dumps(HEAVY_MODULES)] + args)
+        loaded = json.loads(probe.decode())
+        startup["cases"][name] = {"wall": elapsed, "overhead": elapsed - baseline, "heavy_modules": loaded,
+                                  "ok": elapsed - baseline <= budget and not loaded}
+
+    return startup
+
+
+# details of the run that affect the timings, to compare like with like
+def environment():
+    env = {"date": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+           "platform": platform.platform(), "cpus": os.cpu_count(), "gdal": gdal.__version__,
+           "numpy": np.__version__}
+
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                      stderr=subprocess.DEVNULL)
+        env["revision"] = rev.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env["revision"] = None
+
+    return env
+
+
+def Usage():
+    print("Usage: benchmark.py [options]")
+    print("")
+    print("Options:")
+    print("       -s SIZES | --sizes=SIZES          : comma separated map sizes WIDTHxHEIGHT (default=%s)" % ",".join(SIZES))
+    print("       -e EPSGS | --epsg=EPSGS           : comma separated map crs (default=%s, from %s)"
+          % (",".join(str(e) for e in EPSGS), ", ".join(str(e) for e in sorted(CRS_ORIGINS))))
+    print("       -f FORMATS | --formats=FORMATS    : comma separated input formats, tif and pdf (default=tif,pdf)")
+    print("       -n NUM | --repeat=NUM             : number of times each stage and conversion is run (default=3)")
+    print("       -o FILE | --output=FILE           : write the json results to FILE (default=stdout)")
+    print("       -t TEMP | --tmpdir=TEMP           : temporary directory")
+    print("       -k | --keep                       : keep the generated maps and outputs")
+    print("       -b SECS | --budget=SECS           : startup budget of a run that does no conversion (default=%g)" % STARTUP_BUDGET)
+    print("       -S | --startup-only               : only check the startup budget")
+    print("       -v | --verbose                    : increase verbosity")
+    print("       -h | --help                       : show this help message")
+    print("")
+
+
+def main(args=None):
+    Keep = False
+    Verbose = False
+    StartupOnly = False
+    budget = STARTUP_BUDGET
+    ofile = None
+    btmpdir = None
+    sizes = SIZES
+    epsgs = EPSGS
+    formats = ["tif", "pdf"]
+    repeat = 3
+
+    try:
+        short_args = "-hs:e:f:n:o:t:kvb:S"
+        long_args = ["help", "sizes=", "epsg=", "formats=", "repeat=", "output=", "tmpdir=", "keep", "verbose",
+                     "budget=", "startup-only"]
+        if args is None:
+            args = sys.argv
+        opts, args = getopt.getopt(args[1:], short_args, long_args)
+    except getopt.GetoptError as err:
+        Usage()
+        print(err)
+        return 1
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            Usage()
+            return 0
+        elif o in ("-s", "--sizes"):
+            sizes = a.split(",")
+        elif o in ("-e", "--epsg"):
+            try:
+                epsgs = [int(e) for e in a.split(",")]
+            except:
+                Usage()
+                print("epsg codes must be integers")
+                return 1
+        elif o in ("-f", "--formats"):
+            formats = a.lower().split(",")
+        elif o in ("-n", "--repeat"):
+            try:
+                repeat = int(a)
+                if repeat < 1:
+                    Usage()
+                    print("repeat must be greater than 0")
+                    return 1
+            except:
+                Usage()
+                print("repeat must be an integer")
+                return 1
+        elif o in ("-o", "--output"):
+            ofile = a
+        elif o in ("-t", "--tmpdir"):
+            btmpdir = a
+        elif o in ("-k", "--keep"):
+            Keep = True
+        elif o in ("-b", "--budget"):
+            try:
+                budget = float(a)
+            except:
+                Usage()
+                print("budget must be a number of seconds")
+                return 1
+        elif o in ("-S", "--startup-only"):
+            StartupOnly = True
+        elif o in ("-v", "--verbose"):
+            Verbose = True
+        else:
+            Usage()
+            print("unknown option", o, a)
+            return 1
+
+    dims = []
+    for size in sizes:
+        try:
+            xsize, ysize = [int(v) for v in size.lower().split("x")]
+            if xsize < 100 or ysize < 100:
+                raise ValueError
+        except:
+            Usage()
+            print("invalid map size %s, expecting WIDTHxHEIGHT of at least 100x100" % size)
+            return 1
+        dims.append((xsize, ysize))
+
+    for epsg in epsgs:
+        if epsg not in CRS_ORIGINS:
+            Usage()
+            print("unsupported epsg %d" % epsg)
+            return 1
+
+    for fmt in formats:
+        if fmt not in ("tif", "pdf"):
+            Usage()
+            print("invalid format %s" % fmt)
+            return 1
+
+    if btmpdir is not None and not os.path.isdir(btmpdir):
+        Usage()
+        print("temporary directory base is not an existing directory")
+        return 1
+
+    tempd = tempfile.mkdtemp(prefix="bench.", dir=btmpdir)
+    if Verbose:
+        print("Temporary directory: %s" % tempd, file=sys.stderr)
+
+    if StartupOnly:
+        dims = []
+
+    results = {"environment": environment(), "repeat": repeat, "cases": []}
+    try:
+        if Verbose:
+            print("Timing startup", file=sys.stderr)
+        results["startup"] = run_startup(tempd, repeat, budget)
+
+        for xsize, ysize in dims:
+            for epsg in epsgs:
+                for fmt in formats:
+                    case = "%dx%d_%d_%s" % (xsize, ysize, epsg, fmt)
+                    cased = tempd + os.sep + case
+                    os.mkdir(cased)
+
+                    if Verbose:
+                        print("Generating %s" % case, file=sys.stderr)
+
+                    tfile = cased + os.sep + case + ".tif"
+                    make_tif(tfile, xsize, ysize, epsg, fmt == "tif")
+                    if fmt == "pdf":
+                        ifile = cased + os.sep + case + ".pdf"
+                        make_pdf(ifile, tfile)
+                        os.remove(tfile)
+                    else:
+                        ifile = tfile
+
+                    bands = None
+                    if fmt == "pdf":
+                        if Verbose:
+                            print("Checking banded rendering of %s" % case, file=sys.stderr)
+                        rund = cased + os.sep + "bands"
+                        os.mkdir(rund)
+                        bands = check_bands(ifile, rund)
+                        shutil.rmtree(rund)
+
+                    stages = {}
+                    conversions = {}
+                    reports = {}
+                    for i in range(repeat):
+                        if Verbose:
+                            print("Timing %s run %d of %d" % (case, i + 1, repeat), file=sys.stderr)
+
+                        rund = cased + os.sep + "stages"
+                        os.mkdir(rund)
+                        run_stages(ifile, rund, stages)
+                        shutil.rmtree(rund)
+
+                        for name, variant in MAIN_VARIANTS:
+                            rund = cased + os.sep + name
+                            os.mkdir(rund)
+                            reports[name] = run_main(ifile, rund, variant, conversions, name)
+                            shutil.rmtree(rund)
+
+                    summarise(stages)
+                    results["cases"].append({"name": case, "size": [xsize, ysize], "epsg": epsg, "format": fmt,
+                                             "input_bytes": os.path.getsize(ifile), "stages": stages,
+                                             "fastest_warp": fastest_warps(stages),
+                                             "main": summarise(conversions), "main_stats": reports,
+                                             "pdf_bands": bands})
+    finally:
+        if not Keep:
+            shutil.rmtree(tempd, ignore_errors=True)
+
+    if ofile:
+        with open(ofile, 'w') as fh:
+            json.dump(results, fh, indent=1)
+            fh.write("\n")
+    else:
+        print(json.dumps(results, indent=1))
+
+    for name, case in sorted(results["startup"]["cases"].items()):
+        if not case["ok"]:
+            print("startup budget exceeded by %s: %.3fs over the interpreter, heavy modules loaded %s"
+                  % (name, case["overhead"], case["heavy_modules"]), file=sys.stderr)
+            return 1
+
+    for case in results["cases"]:
+        if case["pdf_bands"] is not None and not case["pdf_bands"]["ok"]:
+            print("banded rendering of %s differs from a single pass: %s" % (case["name"], case["pdf_bands"]),
+                  file=sys.stderr)
+            return 1
+
+    return 0
+
+
+# Global vars
+SIZES = ["2000x1500", "6000x4500"]
+EPSGS = [28355, 4326]
+STARTUP_BUDGET = 0.1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+# default size cap of the cache in megabytes
+CACHE_SIZE = 10240
+
+
+# sha256 of a file, read in chunks
+def file_hash(ifile):
+    h = hashlib.sha256()
+    with open(ifile, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+# rasterizations depend on the pdf contents, the dpi and the gdal (pdf renderer) version
+def cache_key(ifile, dpi):
+    from osgeo import gdal
+
+    return "%s-%d-%s" % (file_hash(ifile), dpi, gdal.__version__)
+
+
+def cache_file(cachedir, key):
+    return os.path.join(cachedir, key + ".tif")
+
+
+# cached raster for a key or None, a hit marks the entry as recently used
+def lookup(cachedir, key):
+    cfile = cache_file(cachedir, key)
+    if not os.path.isfile(cfile):
+        return None
+
+    os.utime(cfile, None)
+    return cfile
+
+
+# hard link (or with copy a copy) of the entry cfile at ofile, so a conversion
+# keeps its raster when another process evicts the entry, False if the entry
+# was evicted before it could be claimed
+def claim(cfile, ofile, copy=False):
+    if os.path.lexists(ofile):
+        os.remove(ofile)
+
+    try:
+        if not copy:
+            try:
+                os.link(cfile, ofile)
+                return True
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # no hard links across file systems
+                pass
+        shutil.copyfile(cfile, ofile)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+# file to render a new entry into, hidden from lookups and eviction until stored
+def temp_file(cachedir):
+    return os.path.join(cachedir, ".partial.%s.tif" % uuid.uuid4().hex)
+
+
+# move a rendered raster into the cache and evict old entries over the size cap
+def store(cachedir, key, tmpfile, maxsize):
+    cfile = cache_file(cachedir, key)
+    os.replace(tmpfile, cfile)
+    evict(cachedir, maxsize, cfile)
+
+    return cfile
+
+
+# remove the least recently used entries until the cache fits in maxsize megabytes,
+# the entry keep is never removed, conversions read claimed links of the entries
+# so removing one another process still uses is safe
+def evict(cachedir, maxsize, keep=None):
+    entries = []
+    total = 0
+    for filename in os.listdir(cachedir):
+        fname = os.path.join(cachedir, filename)
+        if filename.startswith(".") or not filename.endswith(".tif") or not os.path.isfile(fname):
+            continue
+        st = os.stat(fname)
+        entries.append((st.st_mtime, fname, st.st_size))
+        total += st.st_size
+
+    entries.sort()
+    for mtime, fname, size in entries:
+        if total <= maxsize * 1024 * 1024:
+            break
+        if keep is not None and os.path.realpath(fname) == os.path.realpath(keep):
+            continue
+        try:
+            os.remove(fname)
+            total -= size
+        except OSError:
+            pass
@@ -1,39 +1,28 @@
 import os
-import fnmatch
+import threading
 
 from osgeo import gdal
 from osgeo import osr
 
+import tile_func
 
-def genkml(ipath, tgt_epsg):
-    topo, ext = os.path.splitext(os.path.basename(ipath))
-
-    ver = gdal.__version__
-    maj_ver = int(ver.split(".")[0])
-
-    fh = open(ipath + os.sep + "doc.kml", 'w')
-    fh.write("""<?xml version="1.0" encoding="iso-8859-1"?>
-<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
-<Document>
-<name>%s</name>"""
-             % topo)
+# coordinate transformations are not thread safe, so the cache is per thread
+_cache = threading.local()
 
-    for filename in fnmatch.filter(os.listdir(ipath), '*.tif'):
 
-        name, ext = os.path.splitext(os.path.basename(filename))
+# cached transformation from the wkt projection to the target epsg
+def get_transform(proj, tgt_epsg):
+    if not hasattr(_cache, "transforms"):
+        _cache.transforms = {}
 
+    key = (proj, tgt_epsg)
+    if key not in _cache.transforms:
         # Thanks to James for the post on Stackexchange for this transform which is
         # licensed under CC BY-SA 2.5for which the following is modified from.
         # https://gis.stackexchange.com/a/201320
 
-        src = gdal.Open(ipath + os.sep + filename)
-        xp = src.RasterXSize
-        yp = src.RasterYSize
-        proj = src.GetProjection()
-
-        ulx, xsize, _, uly, _, ysize = src.GetGeoTransform()
-        lrx = ulx + xp * xsize
-        lry = uly + yp * ysize
+        ver = gdal.__version__
+        maj_ver = int(ver.split(".")[0])
 
         src_ref = osr.SpatialReference()
         src_ref.ImportFromWkt(proj)
@@ -43,39 +32,56 @@ def genkml(ipath, tgt_epsg):
             tgt_ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
         tgt_ref.ImportFromEPSG(tgt_epsg)
 
-        coord_transform = osr.CoordinateTransformation(src_ref, tgt_ref)
-        w, n, _ = coord_transform.TransformPoint(ulx, uly)
-        e, s, _ = coord_transform.TransformPoint(lrx, lry)
+        _cache.transforms[key] = osr.CoordinateTransformation(src_ref, tgt_ref)
 
-        fh.write("""
-<Folder>
+    return _cache.transforms[key]
+
+
+# kml for the tile grid of a raster with geotransform gt in the projection proj
+def genkml(ipath, tgt_epsg, grid, gt, proj):
+    topo, ext = os.path.splitext(os.path.basename(ipath))
+
+    # upper left and lower right corners of every tile in one call
+    corners = []
+    for tname, xoff, yoff, xsize, ysize in grid:
+        ulx, uly, lrx, lry = tile_func.tile_bounds(gt, xoff, yoff, xsize, ysize)
+        corners.append((ulx, uly))
+        corners.append((lrx, lry))
+
+    points = get_transform(proj, tgt_epsg).TransformPoints(corners)
+
+    kml = ["""<?xml version="1.0" encoding="iso-8859-1"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
+<Document>
 <name>%s</name>"""
-                 % name)
+           % topo]
 
-        fh.write("""
-<GroundOverlay>
-<drawOrder>%d</drawOrder>"""
-                 % 1)
+    for i, tile in enumerate(grid):
+        name = tile[0]
+        w, n = points[2 * i][:2]
+        e, s = points[2 * i + 1][:2]
 
-        fh.write("""
+        kml.append("""
+<Folder>
+<name>%s</name>
+<GroundOverlay>
+<drawOrder>%d</drawOrder>
 <Icon>
-<href>files/%s.jpg</href>"""
-                 % name)
-
-        fh.write("""
+<href>files/%s.jpg</href>
 </Icon>
 <LatLonBox>
 <north>%.15g</north>
 <south>%.15g</south>
 <east>%.15g</east>
-<west>%.15g</west>"""
-                 % (n, s, e, w))
-
-        fh.write("""
+<west>%.15g</west>
 </LatLonBox>
 </GroundOverlay>
-</Folder>""")
+</Folder>"""
+                   % (name, 1, name, n, s, e, w))
 
-    fh.write("""
+    kml.append("""
 </Document>
 </kml>""")
+
+    with open(ipath + os.sep + "doc.kml", 'w') as fh:
+        fh.write("".join(kml))
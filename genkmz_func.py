@@ -1,21 +1,118 @@
 import os
+import queue
+import tempfile
+import threading
 import zipfile
 
+# fixed entry timestamp so the same tiles always give the same archive
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# number of entries waiting to be written before producers block
+QUEUE_SIZE = 16
+
+# the process umask, read once at import as reading it means setting it, which
+# would briefly change it for every thread
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+# kmz archive written on a background thread from a bounded queue of entries,
+# the archive only appears at its final path once it is complete
+class KmzWriter:
+    def __init__(self, of, maxqueue=QUEUE_SIZE):
+        self.of = of
+        self.error = None
+        self.queue = queue.Queue(maxqueue)
+
+        fd, self.tmpfile = tempfile.mkstemp(prefix="." + os.path.basename(of) + ".", suffix=".part",
+                                            dir=os.path.dirname(os.path.realpath(of)))
+        self.zip = zipfile.ZipFile(os.fdopen(fd, "wb"), "w")
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # queue an entry, data is either bytes or the path of a file
+    def add(self, arcname, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((arcname, data))
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            if self.error is not None:
+                # keep draining so producers never block on a failed writer
+                continue
+
+            arcname, data = entry
+            try:
+                self.write(arcname, data)
+            except Exception as err:
+                self.error = err
+
+    def write(self, arcname, data):
+        if not isinstance(data, bytes):
+            with open(data, "rb") as fh:
+                data = fh.read()
+
+        info = zipfile.ZipInfo(arcname, ZIP_DATE_TIME)
+        info.external_attr = 0o644 << 16
+        # jpeg is already compressed, only the kml gains from deflate
+        if arcname.lower().endswith(".jpg"):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        self.zip.writestr(info, data)
+
+    # wait for the queued entries and move the archive into place
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+        try:
+            self.zip.close()
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+
+        if self.error is not None:
+            os.remove(self.tmpfile)
+            raise self.error
+
+        # mkstemp creates the file private, give it the usual permissions
+        os.chmod(self.tmpfile, 0o666 & ~UMASK)
+
+        os.replace(self.tmpfile, self.of)
+
+    # stop writing and discard the partial archive
+    def abort(self):
+        if self.error is None:
+            self.error = RuntimeError("kmz writer aborted")
+        self.queue.put(None)
+        self.thread.join()
+
+        try:
+            self.zip.close()
+        except Exception:
+            pass
+        os.remove(self.tmpfile)
+
 
 def genkmz(of, ipath):
     if1 = os.path.join(ipath, 'doc.kml')
     if2 = os.path.join(ipath, 'files')
 
-    zip = zipfile.ZipFile(of, "w")
-
-    arcname = os.path.basename(if1)
-    dname = os.path.dirname(if1)
-    zip.write(if1, arcname)
+    writer = KmzWriter(of)
+    try:
+        writer.add(os.path.basename(if1), if1)
 
-    for filename in os.listdir(if2):
-        fname = os.path.join(if2, filename)
-        pname = os.path.relpath(if2, dname)
-        arcname = os.path.join(pname, filename)
-        zip.write(fname, arcname)
+        for filename in sorted(os.listdir(if2)):
+            writer.add("files/" + filename, os.path.join(if2, filename))
+    except BaseException:
+        writer.abort()
+        raise
 
-    zip.close()
+    writer.close()
@@ -0,0 +1,77 @@
+import contextlib
+
+# layout of intermediate GeoTIFFs and gdal settings for a class of host
+#   ssd   : fast local disk, large uncompressed tiles, plenty of block cache
+#   tmpfs : temp directory in memory, compress to save memory at some cpu cost
+#   lowmem: small block cache and tiles, compressed intermediates
+IO_PROFILES = {
+    'default': {},
+    'ssd': {'tiled': True, 'blocksize': 512, 'compress': 'NONE', 'bigtiff': 'IF_SAFER', 'cachemax': 2048,
+            'threads': 'ALL_CPUS'},
+    'tmpfs': {'tiled': True, 'blocksize': 512, 'compress': 'LZW', 'predictor': 2, 'bigtiff': 'IF_SAFER',
+              'cachemax': 1024, 'threads': 'ALL_CPUS'},
+    'lowmem': {'tiled': True, 'blocksize': 256, 'compress': 'DEFLATE', 'predictor': 2, 'bigtiff': 'IF_SAFER',
+               'cachemax': 64, 'threads': 2},
+}
+
+COMPRESS_METHODS = ["NONE", "LZW", "DEFLATE", "ZSTD", "LZMA", "PACKBITS"]
+BIGTIFF_MODES = ["YES", "NO", "IF_NEEDED", "IF_SAFER"]
+
+
+# GeoTIFF creation options for a profile
+def creation_options(profile):
+    co = []
+    if profile.get('tiled'):
+        co.append("TILED=YES")
+        if profile.get('blocksize'):
+            co.append("BLOCKXSIZE=%d" % profile['blocksize'])
+            co.append("BLOCKYSIZE=%d" % profile['blocksize'])
+    if profile.get('compress'):
+        co.append("COMPRESS=%s" % profile['compress'])
+        if profile.get('predictor') and profile['compress'] != "NONE":
+            co.append("PREDICTOR=%d" % profile['predictor'])
+    if profile.get('bigtiff'):
+        co.append("BIGTIFF=%s" % profile['bigtiff'])
+    if profile.get('threads') and profile.get('compress', "NONE") != "NONE":
+        co.append("NUM_THREADS=%s" % profile['threads'])
+
+    return co
+
+
+# thread local gdal config options while the block runs, the previous values
+# of the calling thread are restored when it exits
+@contextlib.contextmanager
+def thread_config(settings):
+    from osgeo import gdal
+
+    saved = dict((key, gdal.GetThreadLocalConfigOption(key, None)) for key in settings)
+    for key, value in settings.items():
+        gdal.SetThreadLocalConfigOption(key, value)
+
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+
+# gdal settings for a profile while the block runs, restored when it exits
+# the worker threads are only set for the calling thread, the block cache is
+# process wide so conversions run side by side in threads should share a size
+@contextlib.contextmanager
+def gdal_config(profile):
+    from osgeo import gdal
+
+    settings = {}
+    if profile.get('threads'):
+        settings["GDAL_NUM_THREADS"] = str(profile['threads'])
+
+    cachemax = gdal.GetCacheMax()
+    if profile.get('cachemax'):
+        gdal.SetCacheMax(profile['cachemax'] * 1024 * 1024)
+
+    try:
+        with thread_config(settings):
+            yield
+    finally:
+        gdal.SetCacheMax(cachemax)
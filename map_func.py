@@ -1,91 +1,344 @@
 import numpy as np
-from PIL import Image
-
-
-def find_map_extent(ifile, fudge):
-    Image.MAX_IMAGE_PIXELS = None
-    img = Image.open(ifile).convert("L")
-    arr = 255 - np.array(img)
-
-    ny = np.size(arr, 0)
-    nx = np.size(arr, 1)
-
-    ave = -1
-    yu = -1
-    for yp in range(0, int(ny / 2)):
-        ave_t = np.average(arr[yp, :])
-        if ave_t >= ave:
-            ave = ave_t
-            yu = yp
-
-    ave = -1
-    yl = -1
-    for yp in reversed(range(int(ny / 2), ny)):
-        ave_t = np.average(arr[yp, :])
-        if ave_t >= ave:
-            ave = ave_t
-            yl = yp
-
-    ave = -1
-    xl = -1
-    for xp in range(0, int(nx / 2)):
-        ave_t = np.average(arr[:, xp])
-        if ave_t >= ave:
-            ave = ave_t
-            xl = xp
-
-    ave = -1
-    xr = -1
-    for xp in reversed(range(int(nx / 2), nx)):
-        ave_t = np.average(arr[:, xp])
-        if ave_t >= ave:
-            ave = ave_t
-            xr = xp
+from osgeo import gdal
+
+# approximate number of pixels read per window when streaming a raster
+WINDOW_PIXELS = 16 * 1024 * 1024
+
+# initial number of lines read from an edge when trimming borders
+EDGE_LINES = 16
+
+# longest side of the decimated overview searched for candidate gridlines
+OVERVIEW_SIZE = 2048
+
+# smallest decimation worth a coarse search, below it the full scan is as cheap
+MIN_DECIMATION = 4
+
+# overview lines either side of a line whose median is its local background
+BACKGROUND_BINS = 4
+
+# fraction of the most prominent overview line's prominence a candidate needs
+PROMINENCE_RATIO = 0.5
+
+# candidate lines refined in each half of a profile, more is ambiguous
+MAX_CANDIDATES = 8
+
+# overview lines darker on average than this fraction of the darkest refined
+# line might hide a darker line and are refined as well
+AMBIGUITY_RATIO = 0.5
+
+# largest fraction of the overview lines of a half that may be refined
+MAX_REFINED = 0.25
+
+
+# PIL "L" conversion (ITU-R 601-2 luma, rounded) of a window of the raster
+def read_luminance(ds, xoff, yoff, xsize, ysize):
+    if ds.RasterCount >= 3:
+        r, g, b = [ds.GetRasterBand(i).ReadAsArray(xoff, yoff, xsize, ysize).astype(np.uint32) for i in (1, 2, 3)]
+        return ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+    band = ds.GetRasterBand(1)
+    arr = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    ct = band.GetColorTable()
+    if ct is not None:
+        pal = np.zeros((256, 3), np.uint32)
+        for i in range(min(ct.GetCount(), 256)):
+            pal[i] = ct.GetColorEntry(i)[:3]
+        lut = ((pal[:, 0] * 19595 + pal[:, 1] * 38470 + pal[:, 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+        return lut[arr]
+
+    return np.clip(arr, 0, 255).astype(np.uint8)
+
+
+# full width strips aligned to the block height of the raster
+def strips(ds):
+    nx = ds.RasterXSize
+    ny = ds.RasterYSize
+    by = ds.GetRasterBand(1).GetBlockSize()[1]
+    rows = max(by, (WINDOW_PIXELS // nx) // by * by)
+
+    for yoff in range(0, ny, rows):
+        yield yoff, min(rows, ny - yoff)
+
+
+# row and column darkness profiles in a single streaming pass
+def darkness_profiles(ds):
+    rows = np.zeros(ds.RasterYSize, np.int64)
+    cols = np.zeros(ds.RasterXSize, np.int64)
+
+    for yoff, ysize in strips(ds):
+        arr = 255 - read_luminance(ds, 0, yoff, ds.RasterXSize, ysize)
+        rows[yoff:yoff + ysize] = np.sum(arr, axis=1, dtype=np.int64)
+        cols += np.sum(arr, axis=0, dtype=np.int64)
+
+    return rows, cols
+
+
+# index of the first maximum, -1 if empty
+def first_max(profile, offset=0):
+    if len(profile) == 0:
+        return -1
+    return offset + int(np.argmax(profile))
+
+
+# index of the last maximum, -1 if empty
+def last_max(profile, offset=0):
+    if len(profile) == 0:
+        return -1
+    return offset + len(profile) - 1 - int(np.argmax(profile[::-1]))
+
+
+def extent_from_profiles(rows, cols, fudge):
+    ny = len(rows)
+    nx = len(cols)
+
+    # profiles are compared as sums rather than averages, every row (column)
+    # has the same length so the maximum lands on the same line
+    yu = last_max(rows[:ny // 2])
+    yl = first_max(rows[ny // 2:], ny // 2)
+    xl = last_max(cols[:nx // 2])
+    xr = first_max(cols[nx // 2:], nx // 2)
 
     return [xl + fudge, yu + fudge, xr - xl - 2 * fudge + 1, yl - yu - 2 * fudge + 1]
 
 
-def find_map_trim(ifile, border_threshold, fudge):
-    border = border_threshold
+# darkness of an average decimated overview of the raster, None for paletted
+# rasters as their indices cannot be averaged
+def read_overview(ds, cx, cy):
+    nx = ds.RasterXSize
+    ny = ds.RasterYSize
 
-    Image.MAX_IMAGE_PIXELS = None
-    img = Image.open(ifile).convert("L")
-    arr = np.array(img)
+    def read(i):
+        return ds.GetRasterBand(i).ReadAsArray(0, 0, nx, ny, buf_xsize=cx, buf_ysize=cy,
+                                               resample_alg=gdal.GRIORA_Average).astype(np.uint32)
 
-    ny = np.size(arr, 0)
-    nx = np.size(arr, 1)
+    if ds.RasterCount >= 3:
+        r, g, b = [read(i) for i in (1, 2, 3)]
+        lum = (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+    elif ds.GetRasterBand(1).GetColorTable() is not None:
+        return None
+    else:
+        lum = np.clip(read(1), 0, 255)
+
+    return 255 - lum.astype(np.int64)
+
+
+# overview lines of a half profile that stand out from their neighbours, None
+# if none or too many do
+def candidate_bins(profile):
+    w = BACKGROUND_BINS
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(profile, w, mode='edge'), 2 * w + 1)
+    prominence = profile - np.median(windows, axis=1)
+
+    top = prominence.max()
+    if top <= 0:
+        return None
+
+    bins = np.flatnonzero(prominence >= PROMINENCE_RATIO * top)
+    if len(bins) > MAX_CANDIDATES:
+        return None
+
+    return bins
+
+
+# exact darkness of the lines of bands along an axis (0 rows, 1 columns)
+def read_bands(ds, bands, axis, exact):
+    if axis == 0:
+        for start, end in bands:
+            arr = 255 - read_luminance(ds, 0, start, ds.RasterXSize, end - start)
+            exact[start:end] = np.sum(arr, axis=1, dtype=np.int64)
+    else:
+        # the column bands are read together strip by strip
+        for start, end in bands:
+            exact[start:end] = 0
+        for yoff, ysize in strips(ds):
+            for start, end in bands:
+                arr = 255 - read_luminance(ds, start, yoff, end - start, ysize)
+                exact[start:end] += np.sum(arr, axis=0, dtype=np.int64)
 
-    yl_border_width = 0
-    for yp in range(ny):
-        sum = np.sum(arr[yp, :])
-        if sum == border:
-            yl_border_width += 1
-        else:
-            break
 
-    yr_border_width = ny
-    for yp in reversed(range(ny)):
-        sum = np.sum(arr[yp, :])
-        if sum == border:
-            yr_border_width -= 1
+# exact darkness of the lines along an axis (0 rows, 1 columns) in bands around
+# the candidate overview lines of each half, then in any other overview line
+# dark enough on average to hide a darker line, -1 for the lines not refined,
+# None if the overview is ambiguous
+def refine_profile(ds, coarse, axis):
+    if axis == 0:
+        n, length = ds.RasterYSize, ds.RasterXSize
+    else:
+        n, length = ds.RasterXSize, ds.RasterYSize
+
+    edges = np.arange(len(coarse) + 1) * n // len(coarse)
+    halves = []
+    for lo, hi in ((0, n // 2), (n // 2, n)):
+        first = int(np.searchsorted(edges, lo, 'right')) - 1
+        last = int(np.searchsorted(edges, hi, 'left')) - 1
+
+        candidates = candidate_bins(coarse[first:last + 1])
+        if candidates is None:
+            return None
+
+        refined = set()
+        for c in candidates + first:
+            refined.update(b for b in (c - 1, c, c + 1) if first <= b <= last)
+        halves.append((lo, hi, first, last, refined))
+
+    exact = np.full(n, -1, np.int64)
+    bands = [(max(lo, edges[b]), min(hi, edges[b + 1])) for lo, hi, first, last, refined in halves
+             for b in sorted(refined)]
+    read_bands(ds, bands, axis, exact)
+
+    bands = []
+    for lo, hi, first, last, refined in halves:
+        limit = AMBIGUITY_RATIO * exact[lo:hi].max() / length
+        extra = [b for b in range(first, last + 1) if b not in refined and coarse[b] > limit]
+        if len(extra) + len(refined) > MAX_REFINED * (last - first + 1):
+            return None
+        bands.extend((max(lo, edges[b]), min(hi, edges[b + 1])) for b in extra)
+    read_bands(ds, bands, axis, exact)
+
+    return exact
+
+
+# extent from candidate gridlines found on an overview and refined at full
+# resolution, None when the raster is too small or the overview is ambiguous
+def coarse_extent(ds, fudge):
+    nx = ds.RasterXSize
+    ny = ds.RasterYSize
+
+    f = -(-max(nx, ny) // OVERVIEW_SIZE)
+    cx = -(-nx // f)
+    cy = -(-ny // f)
+    if f < MIN_DECIMATION or min(cx, cy) < 2 * (2 * BACKGROUND_BINS + 1):
+        return None
+
+    dark = read_overview(ds, cx, cy)
+    if dark is None:
+        return None
+
+    rows = refine_profile(ds, dark.mean(axis=1), 0)
+    if rows is None:
+        return None
+    cols = refine_profile(ds, dark.mean(axis=0), 1)
+    if cols is None:
+        return None
+
+    return extent_from_profiles(rows, cols, fudge)
+
+
+# with coarse the gridlines are searched for on an overview first, falling back
+# to the full scan when that is ambiguous
+def find_map_extent(ifile, fudge, coarse=False):
+    ds = gdal.Open(ifile)
+
+    if coarse:
+        extent = coarse_extent(ds, fudge)
+        if extent is not None:
+            return extent
+
+    rows, cols = darkness_profiles(ds)
+
+    return extent_from_profiles(rows, cols, fudge)
+
+
+# number of consecutive border lines from one edge, read inward in windows
+# that grow until the first line that is not border
+def edge_width(ds, axis, reverse, border, skip_first=False):
+    nx = ds.RasterXSize
+    ny = ds.RasterYSize
+    if axis == 0:
+        n, other = ny, nx
+    else:
+        n, other = nx, ny
+
+    lines = EDGE_LINES
+    width = 0
+    while width < n:
+        k = min(lines, n - width)
+        if reverse:
+            start = n - width - k
         else:
-            break
+            start = width
 
-    xl_border_width = 0
-    for xp in range(nx):
-        sum = np.sum(arr[1:, xp])
-        if sum == border:
-            xl_border_width += 1
+        if axis == 0:
+            arr = read_luminance(ds, 0, start, nx, k)
+            sums = np.sum(arr, axis=1, dtype=np.int64)
+        elif skip_first and ny == 1:
+            sums = np.zeros(k, np.int64)
         else:
+            yoff = 1 if skip_first else 0
+            arr = read_luminance(ds, start, yoff, k, ny - yoff)
+            sums = np.sum(arr, axis=0, dtype=np.int64)
+
+        if reverse:
+            sums = sums[::-1]
+
+        found = np.flatnonzero(sums != border)
+        if len(found) > 0:
+            return width + int(found[0])
+
+        width += k
+        lines = min(2 * lines, max(EDGE_LINES, WINDOW_PIXELS // other))
+
+    return width
+
+
+# border column widths from the left and right edges of a strip organized
+# raster, where a window of columns would read every strip: the strips are read
+# once from the top, and a column stops being a candidate once its partial sum
+# has passed border, so later strips are only read over the candidate columns
+# the image is still decoded once, but not once per window of columns
+def edge_columns(ds, border):
+    nx = ds.RasterXSize
+    left = np.zeros(nx, np.int64)
+    right = np.zeros(nx, np.int64)
+    nleft = nright = nx
+
+    for yoff, ysize in strips(ds):
+        if nleft == 0 and nright == 0:
             break
 
-    xr_border_width = nx
-    for xp in reversed(range(nx)):
-        sum = np.sum(arr[:, xp])
-        if sum == border:
-            xr_border_width -= 1
+        # the first line is not included when testing the left hand columns
+        skip = 1 if yoff == 0 else 0
+        if nleft > 0 and ysize > skip:
+            arr = read_luminance(ds, 0, yoff + skip, nleft, ysize - skip)
+            left[:nleft] += np.sum(arr, axis=0, dtype=np.int64)
+            over = np.flatnonzero(left[:nleft] > border)
+            if len(over) > 0:
+                nleft = int(over[0])
+
+        if nright > 0:
+            arr = read_luminance(ds, nx - nright, yoff, nright, ysize)
+            right[:nright] += np.sum(arr, axis=0, dtype=np.int64)[::-1]
+            over = np.flatnonzero(right[:nright] > border)
+            if len(over) > 0:
+                nright = int(over[0])
+
+    widths = []
+    for sums, n in ((left, nleft), (right, nright)):
+        found = np.flatnonzero(sums[:n] != border)
+        if len(found) > 0:
+            widths.append(int(found[0]))
         else:
-            break
+            widths.append(n)
+
+    return widths
+
+
+def find_map_trim(ifile, border_threshold, fudge):
+    border = border_threshold
+
+    ds = gdal.Open(ifile)
+    nx = ds.RasterXSize
+    ny = ds.RasterYSize
+
+    yl_border_width = edge_width(ds, 0, False, border)
+    yr_border_width = ny - edge_width(ds, 0, True, border)
+    if ds.GetRasterBand(1).GetBlockSize()[0] >= nx:
+        xl_border_width, xr_width = edge_columns(ds, border)
+        xr_border_width = nx - xr_width
+    else:
+        # the first line is not included when testing the left hand columns
+        xl_border_width = edge_width(ds, 1, False, border, skip_first=True)
+        xr_border_width = nx - edge_width(ds, 1, True, border)
 
     return [xl_border_width + fudge, yl_border_width + fudge, xr_border_width - xl_border_width - 2 * fudge + 1,
             yr_border_width - yl_border_width - 2 * fudge + 1, nx, ny]
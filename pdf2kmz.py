@@ -2,22 +2,25 @@
 
 from __future__ import print_function
 
+import collections
 import csv
-import fnmatch
 import getopt
+import glob
+import hashlib
+import io
 import os
 import shutil
 import sys
 import tempfile
 
-import numpy as np
-from osgeo import gdal
-from osgeo_utils import gdal_retile
-
-import genkml_func
-import genkmz_func
-import map_func
-import tile_func
+# gdal, numpy and the modules built on them are imported by the functions that
+# use them, so help, option errors and existing outputs return without loading them
+import batch_func
+import cache_func
+import io_func
+import stage_func
+import stats_func
+import watch_func
 
 
 # temp directory
@@ -29,101 +32,518 @@ def create_tempdir(prefix, bdir):
 
 # cleanup temp directory
 def cleanup_tempdir(tempd, keep):
+    from osgeo import gdal
+
     if not keep:
         shutil.rmtree(tempd)
 
+    if gdal.VSIStatL(vsimem_dir(tempd)) is not None:
+        gdal.RmdirRecursive(vsimem_dir(tempd))
+
+
+# in-memory directory matching a temp directory, unique to the temp directory
+# path so conversions running side by side never share it
+def vsimem_dir(tempd):
+    digest = hashlib.sha1(os.path.realpath(tempd).encode("utf-8")).hexdigest()[:12]
+    return "/vsimem/%s.%s" % (os.path.basename(tempd), digest)
+
+
+# intermediate file for a pipeline stage, virtual stages are VRTs held in memory
+def stage_file(tempd, stage, name, virtual):
+    if virtual:
+        return vsimem_dir(tempd) + "/" + stage + "/" + name + ".vrt"
+
+    path = tempd + os.sep + stage
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    return path + os.sep + name + ".tif"
+
+
+# warp options for the warp threads, none (gdal's single thread) unless set
+def warp_threads(options):
+    if options.warp_threads is None:
+        return None
+    return ["NUM_THREADS=%s" % options.warp_threads]
+
+
+# run a gdal call with its error messages silenced, a failure is raised as a
+# ConvertError with gdal's last error whether or not gdal exceptions are on
+def quiet_gdal(step, func, *args, **kwargs):
+    from osgeo import gdal
+
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    try:
+        result = func(*args, **kwargs)
+    except RuntimeError as err:
+        raise ConvertError("%s failed: %s" % (step, err))
+    finally:
+        gdal.PopErrorHandler()
+
+    if result is None:
+        raise ConvertError("%s failed: %s" % (step, gdal.GetLastErrorMsg()))
+
+    return result
+
 
 # gdalwarp
-def gdalwarp(ifile, ofile, nodata):
+def gdalwarp(ifile, ofile, options):
+    from osgeo import gdal
+
     src = gdal.Open(ifile)
+    if options.warp_type:
+        wtype = gdal.GetDataTypeByName(options.warp_type)
+    else:
+        wtype = None
     # EPSG:54004 == EPSG:3395
-    opt = gdal.WarpOptions(dstSRS="EPSG:3395", resampleAlg="near", dstNodata=nodata)
+    opt = gdal.WarpOptions(dstSRS="EPSG:3395", resampleAlg="near", dstNodata=options.nodata,
+                           creationOptions=list(options.creation_options),
+                           multithread=options.warp_threads not in (None, 1), warpOptions=warp_threads(options),
+                           warpMemoryLimit=options.warp_memory, errorThreshold=options.warp_error, workingType=wtype)
     gdal.Warp(ofile, src, options=opt)
 
 
-# gdal_retile
-def gdalretile(ifile, opath, xps, yps):
-    retile_argv = ["gdal_retile.py", "-q", "-ps", str(xps), str(yps), "-targetDir", opath, ifile]
-    if 'osgeo_utils.gdal_retile' in sys.modules:
-        gdal_retile.main(retile_argv)
+# clip by a cutline, reproject, trim the black border and rescale in a single
+# warp, the border is found on a virtual warp of the source
+def fused_warp(ifile, ofile, tempd, cutline, options, warped=None):
+    from osgeo import gdal
+    import map_func
+    import tile_func
+
+    src = gdal.Open(ifile)
+    if options.warp_type:
+        wtype = gdal.GetDataTypeByName(options.warp_type)
+    else:
+        wtype = None
+    nodata = options.nodata
+    scale = options.scale
+    border = options.border_offset
+    verbose = options.verbose
+
+    vfile = vsimem_dir(tempd) + "/fused/warped.vrt"
+    opt = gdal.WarpOptions(format="VRT", dstSRS="EPSG:3395", resampleAlg="near", dstNodata=nodata,
+                           cutlineDSName=cutline, cropToCutline=cutline is not None,
+                           errorThreshold=options.warp_error, workingType=wtype)
+    vrt = quiet_gdal("virtual warp", gdal.Warp, vfile, src, options=opt)
+    gt = vrt.GetGeoTransform()
+    del vrt
+
+    if warped:
+        opt = gdal.TranslateOptions(creationOptions=list(options.creation_options))
+        gdal.Translate(warped, vfile, options=opt)
+
+    xoff, yoff, xsize, ysize, nx, ny = map_func.find_map_trim(vfile, 0, border)
+    if xoff - border != 0 or yoff - border != 0 or xoff + xsize + border - 1 != nx or yoff + ysize + border - 1 != ny:
+        if verbose:
+            print("auto clip black border (%d,%d) and size (%d,%d) on image (%d,%d)" % (xoff, yoff, xsize, ysize, nx, ny))
+    else:
+        if verbose:
+            print("a black border does not exist - skipping")
+        xoff, yoff, xsize, ysize = 0, 0, nx, ny
+
+    ulx, uly, lrx, lry = tile_func.tile_bounds(gt, xoff, yoff, xsize, ysize)
+
+    if scale:
+        width = max(1, int(xsize * scale / 100.0 + 0.5))
+        height = max(1, int(ysize * scale / 100.0 + 0.5))
+        alg = options.resample_alg
+        if verbose:
+            print("Rescaling image with scale = %s%% and resampling method = %s" % (scale, alg))
+
+        # the value stretch of gdalscale, gdal_translate -scale maps the
+        # (approximate) range of each band of the trimmed image to 0-255
+        tfile = vsimem_dir(tempd) + "/fused/trimmed.vrt"
+        opt = gdal.TranslateOptions(format="VRT", srcWin=[xoff, yoff, xsize, ysize])
+        trimmed = gdal.Translate(tfile, vfile, options=opt)
+        ranges = []
+        for i in range(trimmed.RasterCount):
+            vmin, vmax = trimmed.GetRasterBand(i + 1).ComputeRasterMinMax(True)
+            ranges.append([vmin, vmax, 0, 255])
+        del trimmed
+        gdal.Unlink(tfile)
     else:
-        gdal_retile(retile_argv)
+        width, height = xsize, ysize
+        alg = "near"
+    gdal.Unlink(vfile)
+
+    if scale:
+        # the stretch is applied as the virtual warp is written, as gdalscale
+        # scales and stretches in one translate
+        sfile = vsimem_dir(tempd) + "/fused/scaled.vrt"
+        opt = gdal.WarpOptions(format="VRT", dstSRS="EPSG:3395", outputBounds=[ulx, lry, lrx, uly], width=width,
+                               height=height, resampleAlg=alg, dstNodata=nodata, cutlineDSName=cutline,
+                               warpOptions=warp_threads(options), warpMemoryLimit=options.warp_memory,
+                               errorThreshold=options.warp_error, workingType=wtype)
+        quiet_gdal("fused warp", gdal.Warp, sfile, src, options=opt)
+        opt = gdal.TranslateOptions(scaleParams=ranges, creationOptions=list(options.creation_options))
+        quiet_gdal("fused warp", gdal.Translate, ofile, sfile, options=opt)
+        gdal.Unlink(sfile)
+    else:
+        opt = gdal.WarpOptions(dstSRS="EPSG:3395", outputBounds=[ulx, lry, lrx, uly], width=width, height=height,
+                               resampleAlg=alg, dstNodata=nodata, cutlineDSName=cutline,
+                               creationOptions=list(options.creation_options),
+                               multithread=options.warp_threads not in (None, 1), warpOptions=warp_threads(options),
+                               warpMemoryLimit=options.warp_memory, errorThreshold=options.warp_error,
+                               workingType=wtype)
+        quiet_gdal("fused warp", gdal.Warp, ofile, src, options=opt)
 
 
-# tif2jpg
-def tif2jpg(ipath, opath, maxsize):
-    gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO")
-    opt = gdal.TranslateOptions(options="-of JPEG -co QUALITY=" + str(JPEG_QUALITY))
-    for filename in fnmatch.filter(os.listdir(ipath), '*.tif'):
-        ifile = ipath + os.sep + filename
-        name, ext = os.path.splitext(os.path.basename(filename))
-        ofile = opath + os.sep + name + ".jpg"
-        src = gdal.Open(ifile)
-        gdal.Translate(ofile, src, options=opt)
+# virtual warp of one sheet of a mosaic to EPSG:3395, expanded to rgb with an
+# alpha band masking everything outside the sheet (or its cutline)
+def sheet_warp(ifile, ofile, cutline, options):
+    from osgeo import gdal
+
+    src = gdal.Open(ifile)
+    if src.RasterCount >= 3:
+        opt = gdal.TranslateOptions(format="VRT", bandList=[1, 2, 3])
+    elif src.GetRasterBand(1).GetColorTable() is not None:
+        opt = gdal.TranslateOptions(format="VRT", rgbExpand="rgb")
+    else:
+        opt = gdal.TranslateOptions(format="VRT", bandList=[1, 1, 1])
+    rgb = os.path.splitext(ofile)[0] + ".rgb.vrt"
+    gdal.Translate(rgb, src, options=opt)
+    del src
+
+    if options.warp_type:
+        wtype = gdal.GetDataTypeByName(options.warp_type)
+    else:
+        wtype = None
+    opt = gdal.WarpOptions(format="VRT", dstSRS="EPSG:3395", resampleAlg="near", dstAlpha=True,
+                           cutlineDSName=cutline, cropToCutline=cutline is not None,
+                           multithread=options.warp_threads not in (None, 1), warpOptions=warp_threads(options),
+                           warpMemoryLimit=options.warp_memory, errorThreshold=options.warp_error, workingType=wtype)
+    vrt = quiet_gdal("warp of %s" % ifile, gdal.Warp, ofile, rgb, options=opt)
+    del vrt
+
+
+# mosaic of the warped sheets, later sheets drawn over earlier ones only where
+# their alpha is set, the rgb bands are kept and are black outside every sheet
+def mosaic_vrt(sheets, ofile):
+    from osgeo import gdal
+
+    mfile = os.path.splitext(ofile)[0] + ".rgba.vrt"
+    vrt = gdal.BuildVRT(mfile, sheets, options=gdal.BuildVRTOptions(resolution="highest"))
+    del vrt
+
+    opt = gdal.TranslateOptions(format="VRT", bandList=[1, 2, 3])
+    vrt = gdal.Translate(ofile, mfile, options=opt)
+    del vrt
 
-        fsize = os.path.getsize(ofile)
-        if fsize > MAX_JPEG_SIZE:
-            print("WARNING: jpeg tile larger than MAX_JPEG_SIZE: %s %d" % (os.path.basename(ofile), fsize))
+
+# tile the final raster to jpeg and stream the tiles into the kmz, returns the
+# name, jpeg size and quality of each tile
+def tif2kmz(ifile, kmzfile, path, xps, yps, options):
+    from osgeo import gdal
+    import genkml_func
+    import genkmz_func
+    import tile_func
+
+    name, ext = os.path.splitext(os.path.basename(ifile))
+
+    src = gdal.Open(ifile)
+    gt = src.GetGeoTransform()
+    proj = src.GetProjection()
+    grid = tile_func.tile_grid(name, src.RasterXSize, src.RasterYSize, xps, yps)
+    del src
+
+    # the kml only needs the tile grid so it goes first in the archive
+    genkml_func.genkml(path, 4326, grid, gt, proj)
+
+    quality = options.quality
+    maxsize = options.max_jpeg_size
+    opath = path + os.sep + "files"
+    if options.keep and not os.path.isdir(opath):
+        os.mkdir(opath)
+
+    tiles = []
+    writer = genkmz_func.KmzWriter(kmzfile)
+    try:
+        writer.add("doc.kml", path + os.sep + "doc.kml")
+
+        fitsize = maxsize if options.adaptive else None
+        for tname, data, bounds, tquality in tile_func.gen_tiles(ifile, grid, quality, options.jpeg_workers, fitsize):
+            if options.verbose and tquality != quality:
+                print("jpeg tile %s.jpg encoded with a quality of %d (%d bytes)" % (tname, tquality, len(data)))
+
+            if len(data) > maxsize:
+                print("WARNING: jpeg tile larger than MAX_JPEG_SIZE: %s.jpg %d" % (tname, len(data)))
+
+            if options.keep:
+                with open(opath + os.sep + tname + ".jpg", 'wb') as fh:
+                    fh.write(data)
+
+            writer.add("files/" + tname + ".jpg", data)
+            tiles.append((tname, len(data), tquality))
+    except BaseException:
+        writer.abort()
+        raise
+
+    writer.close()
+
+    return tiles
+
+
+# superoverlay kmz of the final raster, a tile pyramid whose levels are network
+# linked by region so viewers only load the tiles they show, returns the name,
+# jpeg size and quality of each tile
+def superoverlay2kmz(ifile, kmzfile, path, options):
+    import genkmz_func
+    import superoverlay_func
+
+    name, ext = os.path.splitext(os.path.basename(kmzfile))
+
+    opath = path + os.sep + "files"
+    if options.keep and not os.path.isdir(opath):
+        os.mkdir(opath)
+
+    tiles = []
+    writer = genkmz_func.KmzWriter(kmzfile)
+    try:
+        writer.add("doc.kml", superoverlay_func.doc_kml(name, superoverlay_func.tile_name(0, 0, 0)))
+
+        fitsize = options.max_jpeg_size if options.adaptive else None
+        for arcname, data, tquality in superoverlay_func.gen_superoverlay(ifile, options.quality, options.jpeg_workers,
+                                                                          fitsize):
+            if options.keep:
+                with open(path + os.sep + arcname, 'wb') as fh:
+                    fh.write(data)
+
+            writer.add(arcname, data)
+            if tquality is not None:
+                tiles.append((os.path.basename(arcname), len(data), tquality))
+    except BaseException:
+        writer.abort()
+        raise
+
+    writer.close()
+
+    return tiles
 
 
 # clip
-def clip(ifile, ofile, xoff, yoff, xsize, ysize, proj):
+def clip(ifile, ofile, xoff, yoff, xsize, ysize, proj, options, virtual=False):
+    from osgeo import gdal
+
     if proj:
         opt_str = "-projwin "
     else:
         opt_str = "-srcwin "
-    opt_str += str(xoff) + " " + str(yoff) + " " + str(xsize) + " " + str(ysize) + " -of GTiff"
-    opt = gdal.TranslateOptions(options=opt_str)
+    opt_str += str(xoff) + " " + str(yoff) + " " + str(xsize) + " " + str(ysize)
+    if virtual:
+        opt = gdal.TranslateOptions(options=opt_str + " -of VRT")
+    else:
+        opt = gdal.TranslateOptions(options=opt_str + " -of GTiff", creationOptions=list(options.creation_options))
 
     src = gdal.Open(ifile)
     gdal.Translate(ofile, src, options=opt)
 
 
-def clipbycutline(ifile, ofile, tempd, neatline):
-    ds = gdal.Open(ifile)
+# cutline csv holding a polygon, in memory when virtual
+def write_cutline(tempd, wkt, virtual=False, name="cutline"):
+    from osgeo import gdal
 
-    if not neatline:
-        neatline = ds.GetMetadata()['NEATLINE']
-        cutline = tempd + os.sep + "cutline.csv"
-        header = ['record', 'wkt']
-        row = [1, "%s" % neatline]
+    header = ['record', 'wkt']
+    row = [1, "%s" % wkt]
 
+    if virtual:
+        cutline = vsimem_dir(tempd) + "/" + name + ".csv"
+        fh = io.StringIO(newline='')
+        writer = csv.writer(fh)
+        writer.writerow(header)
+        writer.writerow(row)
+        gdal.FileFromMemBuffer(cutline, fh.getvalue())
+    else:
+        cutline = tempd + os.sep + name + ".csv"
         with open(cutline, 'w', newline='') as fh:
             writer = csv.writer(fh)
             writer.writerow(header)
             writer.writerow(row)
+
+    return cutline
+
+
+def clipbycutline(ifile, ofile, tempd, neatline, options, virtual=False):
+    from osgeo import gdal
+
+    ds = gdal.Open(ifile)
+
+    if not neatline:
+        cutline = write_cutline(tempd, ds.GetMetadata()['NEATLINE'], virtual)
     else:
         cutline = neatline
 
-    opt = gdal.WarpOptions(options="-crop_to_cutline -cutline \"%s\"" % cutline)
-    gdal.PushErrorHandler('CPLQuietErrorHandler')
-    gdal.Warp(ofile, ds, options=opt)
-    gdal.PopErrorHandler()
+    opt = gdal.WarpOptions(options="-crop_to_cutline -cutline \"%s\"" % cutline,
+                           creationOptions=list(options.creation_options))
+    quiet_gdal("clip by cutline", gdal.Warp, ofile, ds, options=opt)
 
 
 # pdf2tif
-def pdf2tif(ifile, ofile):
-    gdal.SetConfigOption("GDAL_PDF_DPI", str(GDAL_PDF_DPI))
-    gdal.SetConfigOption("GDAL_SWATH_SIZE", "1000000000")
+def pdf2tif(ifile, ofile, options):
+    from osgeo import gdal
 
-    src = gdal.Open(ifile)
-    obj = gdal.Translate(ofile, src)
-    del obj
+    # thread local so conversions in other threads keep their own dpi
+    with io_func.thread_config({"GDAL_PDF_DPI": str(options.dpi), "GDAL_SWATH_SIZE": "1000000000"}):
+        # with only a band memory limit, a page that fits in it is rendered in one pass
+        src = gdal.Open(ifile)
+        page_mem = src.RasterXSize * src.RasterYSize * src.RasterCount
+        if options.pdf_bands > 1 or 0 < options.band_mem * 1024 * 1024 < page_mem:
+            if src.GetGeoTransform(can_return_null=True) is None:
+                if options.verbose:
+                    print("pdf is not georeferenced by a geotransform, rendering in a single pass")
+            else:
+                pdf2tif_banded(src, ifile, ofile, options)
+                return
+
+        opt = gdal.TranslateOptions(creationOptions=list(options.creation_options))
+        obj = gdal.Translate(ofile, src, options=opt)
+        del obj
+
+
+# render one horizontal band of a pdf page, with overlap rows above and below
+# that are cropped off so the edges of the band render as inside the page
+def pdf2tif_band(job):
+    from osgeo import gdal
+
+    ifile, ofile, dpi, yoff, ysize, overlap, swath, co = job
+
+    with io_func.thread_config({"GDAL_PDF_DPI": str(dpi), "GDAL_SWATH_SIZE": str(swath)}):
+        src = gdal.Open(ifile)
+        top = min(overlap, yoff)
+        bottom = min(overlap, src.RasterYSize - yoff - ysize)
+        opt = gdal.TranslateOptions(format="MEM", srcWin=[0, yoff - top, src.RasterXSize, top + ysize + bottom])
+        mem = gdal.Translate("", src, options=opt)
+        opt = gdal.TranslateOptions(srcWin=[0, top, src.RasterXSize, ysize], creationOptions=co)
+        obj = gdal.Translate(ofile, mem, options=opt)
+        del obj
+        del mem
+
+    return ofile
+
+
+# render a pdf page as horizontal bands in worker processes and assemble them,
+# the result must be pixel identical to a single pass (benchmark.py checks it)
+def pdf2tif_banded(src, ifile, ofile, options):
+    import multiprocessing
+
+    from osgeo import gdal
+
+    bands = options.pdf_bands
+    band_mem = options.band_mem
+    co = list(options.creation_options)
+    nx = src.RasterXSize
+    ny = src.RasterYSize
+
+    rows = ny // bands + (ny % bands > 0)
+    if band_mem > 0:
+        rows = min(rows, max(1, band_mem * 1024 * 1024 // (nx * src.RasterCount)))
+    overlap = PDF_BAND_OVERLAP
+    swath = max(1, (rows + 2 * overlap) * nx * src.RasterCount)
+
+    name, ext = os.path.splitext(ofile)
+    jobs = []
+    for i, yoff in enumerate(range(0, ny, rows)):
+        jobs.append((ifile, "%s.band%d.tif" % (name, i), options.dpi, yoff, min(rows, ny - yoff), overlap, swath, co))
+
+    workers = min(len(jobs), os.cpu_count() or 1)
+    if options.verbose:
+        print("rendering pdf as %d bands of %d lines on %d workers" % (len(jobs), rows, workers))
+
+    try:
+        # worker processes of a batch cannot start processes of their own
+        if workers > 1 and not multiprocessing.current_process().daemon:
+            pool = multiprocessing.Pool(workers)
+            try:
+                band_files = pool.map(pdf2tif_band, jobs)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            band_files = [pdf2tif_band(job) for job in jobs]
+
+        # the bands carry the georeferencing, the page metadata (neatline) comes from the pdf
+        vrt = gdal.BuildVRT("", band_files)
+        vrt.SetMetadata(src.GetMetadata())
+        opt = gdal.TranslateOptions(creationOptions=co)
+        obj = gdal.Translate(ofile, vrt, options=opt)
+        del obj
+        del vrt
+    finally:
+        for job in jobs:
+            if os.path.exists(job[1]):
+                os.remove(job[1])
 
 
 # gdalscale
-def gdalscale(ifile, ofile, scale, resample_alg):
-    opt_str = "-outsize %d%% %d%% -scale -r %s" % (scale, scale, resample_alg)
-    opt = gdal.TranslateOptions(options=opt_str)
+def gdalscale(ifile, ofile, options):
+    from osgeo import gdal
+
+    scale = options.scale
+    opt_str = "-outsize %d%% %d%% -scale -r %s" % (scale, scale, options.resample_alg)
+    opt = gdal.TranslateOptions(options=opt_str, creationOptions=list(options.creation_options))
 
     src = gdal.Open(ifile)
     gdal.Translate(ofile, src, options=opt)
 
 
 # remove_rotation
-def remove_rotation(ifile, ofile):
+def remove_rotation(ifile, ofile, options):
+    from osgeo import gdal
+
     src = gdal.Open(ifile)
-    gdal.Warp(ofile, src)
+    opt = gdal.WarpOptions(creationOptions=list(options.creation_options))
+    gdal.Warp(ofile, src, options=opt)
+
+
+# final stats report of a conversion, written out if one was requested
+def finish_stats(stats, options, status, tempd=None):
+    report = stats.finish(status, tempd)
+    if options.stats:
+        stats_func.write(report, options.stats)
+
+    return report
+
+
+# list the candidate tilings for an image size
+def print_plan(xp, yp, options):
+    import tile_func
+
+    candidates = tile_func.plan_tiles(xp, yp, options.max_tiles, options.max_tile_res, options.sort_dir,
+                                      options.square_ratio)
+    if len(candidates) == 0 and options.split:
+        return print_split(xp, yp, options)
+    if len(candidates) == 0:
+        print("tiling not found")
+        return 1
+
+    print("%8s %8s %8s %10s %8s %12s" % ("tiles", "layout", "tile", "pixels", "aspect", "wasted"))
+    for ts in candidates:
+        print("%8d %8s %8s %10d %8.3f %12d" % (ts.ntiles, "%dx%d" % (ts.xt, ts.yt), "%dx%d" % (ts.xtile, ts.ytile),
+                                               ts.npix, ts.aspect, ts.waste))
+
+    return 0
+
+
+# list the parts an image with no tiling is split into
+def print_split(xp, yp, options):
+    import tile_func
+
+    parts = tile_func.plan_split(xp, yp, options.max_tiles, options.max_tile_res, options.sort_dir,
+                                 options.square_ratio)
+    if len(parts) == 0:
+        print("tiling not found, not even in %d parts" % tile_func.MAX_PARTS)
+        return 1
+
+    print("%8s %24s %8s %8s %8s" % ("part", "window", "tiles", "layout", "tile"))
+    for i, (xoff, yoff, xsize, ysize, ts) in enumerate(parts):
+        print("%8d %24s %8d %8s %8s" % (i + 1, "%dx%d+%d+%d" % (xsize, ysize, xoff, yoff), ts.ntiles,
+                                        "%dx%d" % (ts.xt, ts.yt), "%dx%d" % (ts.xtile, ts.ytile)))
+
+    return 0
+
+
+# working data types of the warp
+warp_types = ["Byte", "UInt16", "Int16", "UInt32", "Int32", "Float32", "Float64"]
+resample_mthds = ["nearest", "average", "rms", "bilinear", "cubic", "cupicspline", "lanczos", "mode"]
 
 
 def Usage():
@@ -131,11 +551,23 @@ def Usage():
     print("")
     print("Options:")
     print("       -i INPUT_FILE |--input=INPUT_FILE : pdf or tif file to convert to kmz")
+    print("                                           may be repeated, a glob or a directory for batch conversion")
     print("       -o OUT_DIR |--outdir=OUT_DIR      : output directory")
     print("       -f | --force                      : force overwrite of output kmz/tif file if it exists")
     print("       -v | --verbose                    : increase verbosity")
     print("       -h | --help                       : show this help message")
     print("")
+    print("Batch options:")
+    print("       -l LIST | --list=LIST             : file listing input files, one per line")
+    print("       -j NUM | --jobs=NUM               : number of worker processes (default=number of cpus)")
+    print("       --mosaic=NAME                     : combine all inputs into a single kmz NAME.kmz")
+    print("")
+    print("Watch options:")
+    print("       --watch=DIR                       : convert every pdf/tif that appears in DIR until interrupted")
+    print("       --status=FILE                     : status log (default=pdf2kmz-status.log in the output directory)")
+    print("       --settle=SECONDS                  : time a file must stay unchanged before it is converted (default=%g)" % watch_func.SETTLE_TIME)
+    print("       --min-free=MB                     : free temporary space needed to start a conversion (default=%d)" % watch_func.MIN_FREE)
+    print("")
     print("Clip options:")
     print("       -c | --clip                       : auto clip")
     print("       -n | --neatline                   : use embedded neatline to clip")
@@ -143,14 +575,22 @@ def Usage():
     print("       --srcwin xoff,yoff,xsize,ysize    : subwindow to clip in pixels/lines")
     print("       --projwin ulx,uly,lrx,lry         : subwindow to clip in georeferenced coordinates")
     print("       -b PIXELS |--border PIXELS        : additional pixels to remove when auto clipping (default=5)")
+    print("       --coarse-clip                     : auto clip by refining gridlines found on an overview (large rasters)")
     print("       -B PIXELS | -black-border=PIXELS  : additional pixels to remove when clipping the black border (default=5)")
     print("")
     print("PDF to TIF conversion options:")
     print("       -d DPI |--dpi=DPI                 : tif output resolution (default=250)")
     print("       -C | --convert_to_tif             : only convert PDF to TIF")
+    print("       --pdf-bands=NUM                   : render the pdf as this many bands in parallel (default=1)")
+    print("       --band-mem=MB                     : maximum memory used to render each band")
+    print("       --cache=DIR                       : cache pdf rasterizations in this directory")
+    print("       --cache-size=MB                   : maximum size of the cache (default=%d)" % cache_func.CACHE_SIZE)
     print("")
     print("TIF to JPEG conversion options:")
     print("       -q QUAL | --quality=QUAL          : JPEG quality (default=80)")
+    print("       -A | --adaptive-quality           : lower the quality of tiles that would exceed the maximum jpeg size")
+    print("       -w NUM | --jpeg-workers=NUM       : number of threads encoding jpeg tiles (default=number of cpus)")
+    print("       --superoverlay                    : multi-resolution tile pyramid for desktop viewers (not for gps)")
     print("")
     print("Tiling options:")
     print("       -m NUM | --maxtiles=NUM           : maximum number of tiles (default=100)")
@@ -158,6 +598,8 @@ def Usage():
     print("       -p PROFILE | --profile=PROFILE    : gps profile to use (default, etrex, montana, monterra, oregon, gpsmap)")
     print("       -M | --mintilesize                : use the smallest (default=largest) tile size within constraints")
     print("       -S RATIO | --squareratio=RATIO    : only select candidate tilings that have this ratio or less (default=1.2)")
+    print("       --split                           : split an image with no tiling into the fewest kmz parts that fit")
+    print("       --plan WIDTHxHEIGHT               : list the candidate tilings for an image size and exit")
     print("")
     print("Scaling options:")
     print("       -s SCALE | --scale=SCALE          : percentage to scale the image")
@@ -165,96 +607,952 @@ def Usage():
     print("")
     print("Warp options:")
     print("       -R | --remove-nodata              : remove nodata attribute")
+    print("       --warp-threads=NUM                : warp threads, a number or ALL_CPUS (default=%s)" % WARP_THREADS)
+    print("       --warp-mem=MB                     : warp memory limit (default=gdal's)")
+    print("       --warp-error=PIXELS               : approximate transformer error, 0 for exact (default=gdal's)")
+    print("       --warp-type=TYPE                  : warp working data type (%s)" % ", ".join(warp_types))
+    print("")
+    print("Intermediate raster options:")
+    print("       --io-profile=PROFILE              : raster layout and gdal settings preset (%s)" % ", ".join(io_func.IO_PROFILES))
+    print("       --blocksize=PIXELS                : write tiled intermediates with this block size")
+    print("       --compress=ALG                    : compression of intermediates (%s)" % ", ".join(io_func.COMPRESS_METHODS))
+    print("       --predictor=NUM                   : compression predictor (1=none, 2=horizontal)")
+    print("       --bigtiff=MODE                    : BigTIFF mode of intermediates (%s)" % ", ".join(io_func.BIGTIFF_MODES))
+    print("       --cachemax=MB                     : gdal block cache size")
+    print("       --num-threads=NUM                 : gdal worker threads (a number or ALL_CPUS)")
     print("")
     print("Temporary directory options:")
     print("       -t TEMP | --tmpdir=TEMP           : temporary directory")
     print("       -k | --keep                       : keep temporary files")
+    print("       -F | --fused                      : clip, warp and rescale in a single warp, -k keeps only its warped stage")
+    print("       -V | --virtual                    : keep clip and border stages virtual (ignored with -k)")
+    print("       -W DIR | --workdir=DIR            : persistent work directory, only rebuild stages whose inputs changed")
+    print("")
+    print("Report options:")
+    print("       --stats=FILE                      : write stage timings, memory and output sizes as json")
     print("")
 
 
-def main(args=None):
-    global GDAL_PDF_DPI
-    global JPEG_QUALITY
-    global MAX_TILES
-    global MAX_TILE_RES
-    global IMAGE_SCALE
-    global RESAMPLE_ALG
-    global SORT_DIR
-    global SQUARE_RATIO
-    global MAX_JPEG_SIZE
-    global CLIP_OFFSET
-    global BORDER_OFFSET
-    global WARP_NODATA
+# a conversion that cannot be started or a gdal step that failed, the message
+# says why
+class ConvertError(Exception):
+    pass
+
+
+# convert a pdf or tif to a kmz (or with options.tif a pdf to a tif), returns the
+# output file and the stats report of the conversion
+# all settings come from options and nothing is shared between calls, so
+# conversions can run one after another or side by side in threads
+def convert(ifile, options=None):
+    if options is None:
+        options = Options()
+    Verbose = options.verbose
+
+    if Verbose:
+        print("Input file = %s" % ifile)
+
+    if not os.path.isfile(ifile):
+        raise ConvertError("input file does not exist: %s" % ifile)
+
+    if options.nfile is not None and not os.path.isfile(options.nfile):
+        raise ConvertError("neatline file does not exist: %s" % options.nfile)
+
+    clips = [options.autoclip, options.srcwin is not None, options.projwin is not None, options.neatline,
+             options.nfile is not None]
+    if sum(1 for c in clips if c) > 1:
+        raise ConvertError("only specify one clipping option")
+
+    if options.resample_alg not in resample_mthds:
+        raise ConvertError("invalid resampling algorithm %s" % resample_mthds)
+
+    if options.workdir and options.tmpdir:
+        raise ConvertError("work directory cannot be specified with tmpdir")
+
+    if options.cache and not os.path.isdir(options.cache):
+        try:
+            os.makedirs(options.cache, exist_ok=True)
+        except OSError:
+            raise ConvertError("cannot create cache directory")
+
+    # stages in a work directory are kept between runs
+    if options.workdir:
+        options = options._replace(keep=True)
+
+    if options.virtual and options.keep:
+        options = options._replace(virtual=False)
+        if Verbose:
+            print("keeping temporary files, all stages will be written to disk")
+
+    Keep = options.keep
+
+    name, ext = os.path.splitext(os.path.basename(ifile))
+    if not options.outdir:
+        odir = os.path.dirname(os.path.realpath(ifile))
+    else:
+        odir = options.outdir
+        if not os.path.isdir(odir):
+            try:
+                os.makedirs(odir, exist_ok=True)
+            except OSError:
+                raise ConvertError("cannot create output directory")
+
+    if Verbose:
+        print("Output directory = %s" % odir)
+
+    if options.tif:
+        if ext.lower() != ".pdf":
+            raise ConvertError("only a pdf can be converted to tif: %s" % ifile)
+        ofile = odir + os.sep + name + ".tif"
+    else:
+        ofile = odir + os.sep + name + ".kmz"
+    if os.path.exists(ofile):
+        if not os.path.isfile(ofile):
+            raise ConvertError("output file %s exists but is not a regular file" % ofile)
+        if not options.force:
+            raise ConvertError("output file %s exists, -f to force overwrite" % ofile)
+
+    profile = {'cachemax': options.cachemax, 'threads': options.num_threads}
+
+    stats = stats_func.Stats(ifile)
+    stats.set("output", ofile)
+
+    if options.tif:
+        with io_func.gdal_config(profile):
+            if options.cache:
+                cached_pdf2tif(ifile, ofile, options, stats, copy=True)
+            else:
+                if Verbose:
+                    print("Coverting input pdf to tif with dpi = %d" % options.dpi)
+                with stats.stage("pdf2tif", ofile):
+                    pdf2tif(ifile, ofile, options)
+
+        return Result(ofile, finish_stats(stats, options, "ok"))
+
+    kmzfile = ofile
+
+    if options.tmpdir:
+        if not os.path.isdir(options.tmpdir):
+            raise ConvertError("temporary directory base is not an existing directory")
+        btmpdir = os.path.realpath(options.tmpdir)
+    else:
+        btmpdir = None
 
+    if options.workdir:
+        tempd = os.path.realpath(options.workdir) + os.sep + name
+        try:
+            os.makedirs(tempd, exist_ok=True)
+        except OSError:
+            raise ConvertError("cannot create work directory")
+
+        if Verbose:
+            print("Work directory: %s" % tempd)
+
+        manifest = stage_func.Manifest(tempd)
+    else:
+        tempd = create_tempdir(name, btmpdir)
+
+        if Verbose:
+            print("Temporary directory: %s" % tempd)
+
+        manifest = stage_func.Manifest()
+
+    try:
+        with io_func.gdal_config(profile):
+            report = run_pipeline(ifile, kmzfile, tempd, manifest, options, stats)
+    finally:
+        cleanup_tempdir(tempd, Keep)
+
+    return Result(report["output"], report)
+
+
+# rasterize a pdf through the cache into ofile, a link to (or with copy a copy
+# of) the cache entry that stays readable if another process evicts the entry
+def cached_pdf2tif(ifile, ofile, options, stats, copy=False):
+    key = cache_func.cache_key(ifile, options.dpi)
+    cfile = cache_func.lookup(options.cache, key)
+    if cfile is not None and cache_func.claim(cfile, ofile, copy):
+        if options.verbose:
+            print("pdf cache hit: %s" % cfile)
+        stats.set("pdf_cache", "hit")
+    else:
+        if options.verbose:
+            print("pdf cache miss, coverting input pdf to tif with dpi = %d" % options.dpi)
+
+        # claimed before it is stored, once stored it can be evicted
+        tmpfile = cache_func.temp_file(options.cache)
+        try:
+            with stats.stage("pdf2tif", tmpfile):
+                pdf2tif(ifile, tmpfile, options)
+            cache_func.claim(tmpfile, ofile, copy)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        cache_func.store(options.cache, key, tmpfile, options.cache_size)
+        stats.set("pdf_cache", "miss")
+
+    return ofile
+
+
+# the pipeline stages of a kmz conversion in the temp (or work) directory tempd,
+# returns the stats report
+def run_pipeline(ifile, kmzfile, tempd, manifest, options, stats):
+    from osgeo import gdal
+    import map_func
+
+    Verbose = options.verbose
+    Keep = options.keep
+    Virtual = options.virtual
+    AutoClip = options.autoclip
+    Srcwin = options.srcwin is not None
+    Projwin = options.projwin is not None
+    Neatline = options.neatline
+    Nfile = options.nfile is not None
+    nfile = options.nfile
+    Scale = options.scale is not None
+    if Srcwin:
+        win = options.srcwin
+    elif Projwin:
+        win = options.projwin
+
+    name, ext = os.path.splitext(os.path.basename(ifile))
+    prev = manifest.source_key(ifile)
+
+    if ext.lower() == ".pdf" and options.cache:
+        ofile = cached_pdf2tif(ifile, stage_file(tempd, "tif", name, False), options, stats)
+        prev = manifest.key("tif", prev, {"dpi": options.dpi})
+    elif ext.lower() == ".pdf":
+        path = tempd + os.sep + "tif"
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        ofile = path + os.sep + name + ".tif"
+
+        prev = manifest.key("tif", prev, {"dpi": options.dpi})
+        if manifest.fresh("tif", prev, ofile):
+            if Verbose:
+                print("Input pdf already converted to tif with dpi = %d" % options.dpi)
+        else:
+            if Verbose:
+                print("Coverting input pdf to tif with dpi = %d" % options.dpi)
+
+            with stats.stage("pdf2tif", ofile):
+                pdf2tif(ifile, ofile, options)
+            manifest.record("tif", prev, ofile)
+    else:
+        if Verbose:
+            print("Input file in tif format: %s" % ifile)
+        ofile = ifile
+
+    if options.fused:
+        ifile = ofile
+        name, ext = os.path.splitext(os.path.basename(ifile))
+        ofile = stage_file(tempd, "fused", name, False)
+
+        prev = manifest.key("fused", prev, {"autoclip": AutoClip and options.clip_offset,
+                                            "coarse": AutoClip and options.coarse_clip,
+                                            "srcwin": Srcwin and [int(v) for v in win],
+                                            "projwin": Projwin and [float(v) for v in win], "neatline": Neatline,
+                                            "nfile": Nfile and manifest.source_key(nfile), "nodata": options.nodata,
+                                            "error": options.warp_error, "type": options.warp_type,
+                                            "border": options.border_offset, "scale": options.scale,
+                                            "algorithm": options.resample_alg})
+        if manifest.fresh("fused", prev, ofile):
+            if Verbose:
+                print("fused warp is up to date")
+        else:
+            if AutoClip or Srcwin:
+                if AutoClip:
+                    if Verbose:
+                        print("Using auto clip with offset=%d" % options.clip_offset)
+                    with stats.stage("find_map_extent"):
+                        xoff, yoff, xsize, ysize = map_func.find_map_extent(ifile, options.clip_offset, options.coarse_clip)
+                else:
+                    xoff, yoff, xsize, ysize = win
+
+                if Verbose:
+                    print("clip window offset (%d,%d) and size (%d,%d)" % (xoff, yoff, xsize, ysize))
+
+                # the window is read through the warp, it is never written
+                wfile = stage_file(tempd, "clipped", name, True)
+                with stats.stage("clip", wfile):
+                    clip(ifile, wfile, xoff, yoff, xsize, ysize, False, options, True)
+                ifile = wfile
+
+            if Neatline:
+                cutline = write_cutline(tempd, gdal.Open(ifile).GetMetadata()['NEATLINE'], not Keep)
+            elif Nfile:
+                cutline = nfile
+            elif Projwin:
+                ulx, uly, lrx, lry = win
+                cutline = write_cutline(tempd, "POLYGON ((%.17g %.17g, %.17g %.17g, %.17g %.17g, %.17g %.17g, %.17g %.17g))"
+                                        % (ulx, uly, lrx, uly, lrx, lry, ulx, lry, ulx, uly), not Keep)
+            else:
+                cutline = None
+
+            if Keep:
+                warped = stage_file(tempd, "warped", name, False)
+            else:
+                warped = None
+
+            if Verbose:
+                print("Running fused clip, gdalwarp and rescale")
+
+            with stats.stage("fused_warp", ofile):
+                fused_warp(ifile, ofile, tempd, cutline, options, warped)
+            manifest.record("fused", prev, ofile)
+    else:
+        if AutoClip:
+            ifile = ofile
+            name, ext = os.path.splitext(os.path.basename(ifile))
+            ofile = stage_file(tempd, "clipped", name, Virtual)
+
+            prev = manifest.key("clipped", prev, {"auto": options.clip_offset, "coarse": options.coarse_clip})
+            if manifest.fresh("clipped", prev, ofile):
+                if Verbose:
+                    print("auto clip is up to date")
+            else:
+                if Verbose:
+                    print("Using auto clip with offset=%d" % options.clip_offset)
+
+                with stats.stage("find_map_extent"):
+                    xoff, yoff, xsize, ysize = map_func.find_map_extent(ifile, options.clip_offset, options.coarse_clip)
+
+                if Verbose:
+                    print("auto clip offset (%d,%d) and size (%d,%d)" % (xoff, yoff, xsize, ysize))
+
+                with stats.stage("clip", ofile):
+                    clip(ifile, ofile, xoff, yoff, xsize, ysize, False, options, Virtual)
+                manifest.record("clipped", prev, ofile)
+        elif Srcwin:
+            ifile = ofile
+            name, ext = os.path.splitext(os.path.basename(ifile))
+            ofile = stage_file(tempd, "clipped", name, Virtual)
+            xoff, yoff, xsize, ysize = win
+
+            prev = manifest.key("clipped", prev, {"srcwin": [int(v) for v in win]})
+            if manifest.fresh("clipped", prev, ofile):
+                if Verbose:
+                    print("srcwin clip is up to date")
+            else:
+                if Verbose:
+                    print("clip using srcwin offset (%d %d) and size (%d %d)" % (xoff, yoff, xsize, ysize))
+
+                with stats.stage("clip", ofile):
+                    clip(ifile, ofile, xoff, yoff, xsize, ysize, False, options, Virtual)
+                manifest.record("clipped", prev, ofile)
+
+        if Projwin:
+            ifile = ofile
+            ofile = stage_file(tempd, "rotated", name, False)
+
+            prev = manifest.key("rotated", prev, {})
+            if manifest.fresh("rotated", prev, ofile):
+                if Verbose:
+                    print("Rotation already removed from input file")
+            else:
+                if Verbose:
+                    print("Removing rotation from input file")
+
+                with stats.stage("remove_rotation", ofile):
+                    remove_rotation(ifile, ofile, options)
+                manifest.record("rotated", prev, ofile)
+
+        if Neatline or Nfile:
+            ifile = ofile
+            name, ext = os.path.splitext(os.path.basename(ifile))
+            ofile = stage_file(tempd, "clipped", name, False)
+
+            if Nfile:
+                prev = manifest.key("clipped", prev, {"nfile": manifest.source_key(nfile)})
+            else:
+                prev = manifest.key("clipped", prev, {"neatline": True})
+            if manifest.fresh("clipped", prev, ofile):
+                if Verbose:
+                    print("neatline clip is up to date")
+            else:
+                if Verbose:
+                    if Nfile:
+                        print("Using neatline csv file to clip")
+                    else:
+                        print("Using neatline to clip")
+
+                with stats.stage("clipbycutline", ofile):
+                    clipbycutline(ifile, ofile, tempd, nfile, options, Virtual)
+                manifest.record("clipped", prev, ofile)
+        elif Projwin:
+            ifile = ofile
+            name, ext = os.path.splitext(os.path.basename(ifile))
+            ofile = stage_file(tempd, "clipped", name, Virtual)
+            xoff, yoff, xsize, ysize = win
+
+            prev = manifest.key("clipped", prev, {"projwin": [float(v) for v in win]})
+            if manifest.fresh("clipped", prev, ofile):
+                if Verbose:
+                    print("projwin clip is up to date")
+            else:
+                if Verbose:
+                    print("clip using projwin offset (%d %d) and size (%d %d)" % (xoff, yoff, xsize, ysize))
+
+                with stats.stage("clip", ofile):
+                    clip(ifile, ofile, xoff, yoff, xsize, ysize, True, options, Virtual)
+                manifest.record("clipped", prev, ofile)
+
+        ifile = ofile
+        name, ext = os.path.splitext(os.path.basename(ifile))
+        ofile = stage_file(tempd, "warped", name, False)
+
+        prev = manifest.key("warped", prev, {"nodata": options.nodata, "error": options.warp_error,
+                                             "type": options.warp_type})
+        if manifest.fresh("warped", prev, ofile):
+            if Verbose:
+                print("warped file is up to date")
+        else:
+            if Verbose:
+                print("Running gdalwarp")
+
+            with stats.stage("gdalwarp", ofile):
+                gdalwarp(ifile, ofile, options)
+            manifest.record("warped", prev, ofile)
+
+        ifile = ofile
+        name, ext = os.path.splitext(os.path.basename(ifile))
+        bfile = stage_file(tempd, "border", name, Virtual)
+        border = options.border_offset
+
+        prev = manifest.key("border", prev, {"border": border})
+        if manifest.fresh("border", prev, manifest.output("border") or bfile):
+            if Verbose:
+                print("black border clip is up to date")
+            ofile = manifest.output("border")
+        else:
+            with stats.stage("find_map_trim"):
+                xoff, yoff, xsize, ysize, nx, ny = map_func.find_map_trim(ifile, 0, border)
+            if xoff - border != 0 or yoff - border != 0 or xoff + xsize + border - 1 != nx or yoff + ysize + border - 1 != ny:
+                ofile = bfile
+
+                if Verbose:
+                    print("auto clip black border (%d,%d) and size (%d,%d) on image (%d,%d)" % (xoff, yoff, xsize, ysize, nx, ny))
+
+                with stats.stage("clip_border", ofile):
+                    clip(ifile, ofile, xoff, yoff, xsize, ysize, False, options, Virtual)
+            else:
+                if Verbose:
+                    print("a black border does not exist - skipping")
+
+            # without a border the stage output is the warped file itself
+            manifest.record("border", prev, ofile)
+
+        if Scale:
+            ifile = ofile
+            name, ext = os.path.splitext(os.path.basename(ifile))
+            ofile = stage_file(tempd, "rescaled", name, False)
+
+            prev = manifest.key("rescaled", prev, {"scale": options.scale, "algorithm": options.resample_alg})
+            if manifest.fresh("rescaled", prev, ofile):
+                if Verbose:
+                    print("rescaled file is up to date")
+            else:
+                if Verbose:
+                    print("Rescaling image with scale = %s%% and resampling method = %s" % (options.scale,
+                                                                                             options.resample_alg))
+
+                with stats.stage("gdalscale", ofile):
+                    gdalscale(ifile, ofile, options)
+                manifest.record("rescaled", prev, ofile)
+
+    prev = manifest.key("kmz", prev, {"kmz": os.path.realpath(kmzfile), "quality": options.quality,
+                                      "maxtiles": options.max_tiles, "maxtileres": options.max_tile_res,
+                                      "sort": options.sort_dir, "squareratio": options.square_ratio,
+                                      "adaptive": options.adaptive, "maxjpegsize": options.max_jpeg_size,
+                                      "split": options.split, "superoverlay": options.superoverlay})
+    if manifest.fresh("kmz", prev, manifest.output("kmz") or kmzfile):
+        if Verbose:
+            print("kmz file is up to date: %s" % manifest.output("kmz"))
+        return finish_stats(stats, options, "ok", tempd)
+
+    # a split conversion is recorded by its first part
+    outputs = tile_kmz(ofile, kmzfile, tempd, options, stats)
+    manifest.record("kmz", prev, outputs[0])
+
+    return finish_stats(stats, options, "ok", tempd)
+
+
+# tile the final raster ofile into kmzfile, or when it has no tiling and
+# options.split is set into the fewest parts that have one, each its own kmz
+# built side by side, or with options.superoverlay into a tile pyramid,
+# returns the kmz files
+def tile_kmz(ofile, kmzfile, tempd, options, stats):
+    import concurrent.futures
+    import importlib
+
+    from osgeo import gdal
+    import superoverlay_func
+    import tile_func
+
+    # loaded before any tiling thread starts, genkmz_func reads the umask on
+    # import by briefly setting it to 0 for the whole process
+    importlib.import_module("genkmz_func")
+
+    Verbose = options.verbose
+
+    src = gdal.Open(ofile)
+    xp = src.RasterXSize
+    yp = src.RasterYSize
+    del src
+
+    path = tempd + os.sep + "tiled"
+    if not os.path.isdir(path):
+        os.mkdir(path)
+
+    # a superoverlay is not loaded onto a device, so no tile limits apply
+    if options.superoverlay:
+        if Verbose:
+            print("Generating superoverlay kmz = %s" % kmzfile)
+
+        with stats.stage("superoverlay"):
+            tiles = superoverlay2kmz(ofile, kmzfile, path, options)
+
+        if Verbose:
+            print("superoverlay with %d tiles in %d levels" % (len(tiles), superoverlay_func.levels(xp, yp)))
+
+        stats.set("levels", superoverlay_func.levels(xp, yp))
+        stats.set("tiles", len(tiles))
+        stats.set("jpeg_bytes", [size for tname, size, quality in tiles])
+        if options.adaptive:
+            stats.set("jpeg_quality", [quality for tname, size, quality in tiles])
+        stats.set("kmz_bytes", os.path.getsize(kmzfile))
+
+        return [kmzfile]
+
+    if Verbose:
+        print("Maximum number of tiles = %d" % options.max_tiles)
+        print("Maximum tile resolution = %d" % options.max_tile_res)
+
+    candidates = tile_func.plan_tiles(xp, yp, options.max_tiles, options.max_tile_res, options.sort_dir,
+                                      options.square_ratio)
+    if len(candidates) > 0:
+        parts = [(ofile, kmzfile, None, candidates[0])]
+    elif options.split:
+        split = tile_func.plan_split(xp, yp, options.max_tiles, options.max_tile_res, options.sort_dir,
+                                     options.square_ratio)
+        if len(split) == 0:
+            finish_stats(stats, options, "failed", tempd)
+            raise ConvertError("tiling not found, not even in %d parts" % tile_func.MAX_PARTS)
+
+        if Verbose:
+            print("no tiling fits the image (%d,%d), splitting it into %d parts" % (xp, yp, len(split)))
+
+        name, ext = os.path.splitext(os.path.basename(ofile))
+        base, ext = os.path.splitext(kmzfile)
+        parts = []
+        for i, (xoff, yoff, xsize, ysize, ts) in enumerate(split):
+            pfile = stage_file(tempd, "parts", "%s_part%d" % (name, i + 1), True)
+            pkmz = "%s_part%d.kmz" % (base, i + 1)
+            if os.path.exists(pkmz) and not options.force:
+                finish_stats(stats, options, "failed", tempd)
+                raise ConvertError("output file %s exists, -f to force overwrite" % pkmz)
+
+            clip(ofile, pfile, xoff, yoff, xsize, ysize, False, options, True)
+            parts.append((pfile, pkmz, [xoff, yoff, xsize, ysize], ts))
+    else:
+        finish_stats(stats, options, "failed", tempd)
+        raise ConvertError("tiling not found")
+
+    # the parts share the jpeg workers
+    workers = min(len(parts), options.jpeg_workers)
+    toptions = options._replace(jpeg_workers=max(1, options.jpeg_workers // workers))
+    with stats.stage("tif2kmz"):
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = []
+                for pfile, pkmz, window, ts in parts:
+                    # the kml document of a part is named after the directory
+                    if len(parts) > 1:
+                        ppath = path + os.sep + os.path.splitext(os.path.basename(pkmz))[0]
+                        if not os.path.isdir(ppath):
+                            os.mkdir(ppath)
+                    else:
+                        ppath = path
+
+                    if Verbose:
+                        print("retiling with %dx%d tile to jpeg with a quality of %s" % (ts.xtile, ts.ytile,
+                                                                                        options.quality))
+                        print("Generating kmz = %s" % pkmz)
+
+                    futures.append(executor.submit(tif2kmz, pfile, pkmz, ppath, ts.xtile, ts.ytile, toptions))
+                results = [future.result() for future in futures]
+        except BaseException:
+            # the pool has waited for every part, a partial set of parts is
+            # removed so a failed split leaves no kmz behind
+            if len(parts) > 1:
+                for pfile, pkmz, window, ts in parts:
+                    if os.path.isfile(pkmz):
+                        os.remove(pkmz)
+            raise
+
+    tiles = []
+    for (pfile, pkmz, window, ts), ptiles in zip(parts, results):
+        if Verbose:
+            print("retiled %s with %d tiles (%dx%d)" % (pkmz, ts.ntiles, ts.xt, ts.yt))
+        tiles.extend(ptiles)
+
+    outputs = [pkmz for pfile, pkmz, window, ts in parts]
+    if len(parts) > 1:
+        stats.set("output", outputs)
+        stats.set("parts", [{"kmz": pkmz, "window": window, "tiling": [ts.xt, ts.yt, ts.xtile, ts.ytile],
+                             "tiles": len(ptiles)} for (pfile, pkmz, window, ts), ptiles in zip(parts, results)])
+    else:
+        ts = parts[0][3]
+        stats.set("tiling", [ts.xt, ts.yt, ts.xtile, ts.ytile])
+    stats.set("tiles", len(tiles))
+    stats.set("jpeg_bytes", [size for tname, size, quality in tiles])
+    if options.adaptive:
+        stats.set("jpeg_quality", [quality for tname, size, quality in tiles])
+    stats.set("kmz_bytes", sum(os.path.getsize(pkmz) for pkmz in outputs))
+
+    return outputs
+
+
+# convert adjacent sheets (pdf or tif) into a single kmz named name, returns the
+# kmz and the stats report
+# each sheet is clipped by its neatline or auto clip and warped virtually, the
+# mosaic of the warped sheets is a VRT too, so apart from the rendering of pdf
+# sheets only the tiles being encoded are ever read into memory
+# the VRTs read every rendered pdf sheet until the tiling ends, so all of their
+# tifs are kept in tempd at once (as links to the entries with a cache)
+def convert_mosaic(ifiles, name, options=None):
+    if options is None:
+        options = Options()
+    Verbose = options.verbose
+
+    if len(ifiles) == 0:
+        raise ConvertError("no input files for the mosaic")
+
+    for ifile in ifiles:
+        if not os.path.isfile(ifile):
+            raise ConvertError("input file does not exist: %s" % ifile)
+
+    if options.autoclip and options.neatline:
+        raise ConvertError("only specify one clipping option")
+
+    if options.srcwin is not None or options.projwin is not None or options.nfile is not None:
+        raise ConvertError("a mosaic clips each sheet by its neatline or auto clip")
+
+    if options.tif or options.workdir:
+        raise ConvertError("a mosaic cannot be converted to tif or use a work directory")
+
+    if options.resample_alg not in resample_mthds:
+        raise ConvertError("invalid resampling algorithm %s" % resample_mthds)
+
+    if options.cache and not os.path.isdir(options.cache):
+        try:
+            os.makedirs(options.cache, exist_ok=True)
+        except OSError:
+            raise ConvertError("cannot create cache directory")
+
+    if not options.outdir:
+        odir = os.path.dirname(os.path.realpath(ifiles[0]))
+    else:
+        odir = options.outdir
+        if not os.path.isdir(odir):
+            try:
+                os.makedirs(odir, exist_ok=True)
+            except OSError:
+                raise ConvertError("cannot create output directory")
+
+    kmzfile = odir + os.sep + name + ".kmz"
+    if os.path.exists(kmzfile):
+        if not os.path.isfile(kmzfile):
+            raise ConvertError("output file %s exists but is not a regular file" % kmzfile)
+        if not options.force:
+            raise ConvertError("output file %s exists, -f to force overwrite" % kmzfile)
+
+    if options.tmpdir:
+        if not os.path.isdir(options.tmpdir):
+            raise ConvertError("temporary directory base is not an existing directory")
+        btmpdir = os.path.realpath(options.tmpdir)
+    else:
+        btmpdir = None
+
+    if Verbose:
+        print("Mosaic of %d sheets = %s" % (len(ifiles), kmzfile))
+
+    profile = {'cachemax': options.cachemax, 'threads': options.num_threads}
+
+    stats = stats_func.Stats(list(ifiles))
+    stats.set("output", kmzfile)
+
+    tempd = create_tempdir(name, btmpdir)
+    if Verbose:
+        print("Temporary directory: %s" % tempd)
+
+    try:
+        with io_func.gdal_config(profile):
+            report = run_mosaic(ifiles, kmzfile, tempd, options, stats)
+    finally:
+        cleanup_tempdir(tempd, options.keep)
+
+    return Result(report["output"], report)
+
+
+# the stages of a mosaic conversion in the temp directory tempd, returns the
+# stats report
+def run_mosaic(ifiles, kmzfile, tempd, options, stats):
+    from osgeo import gdal
+    import map_func
+
+    Verbose = options.verbose
+    name, ext = os.path.splitext(os.path.basename(kmzfile))
+
+    sheets = []
+    for i, ifile in enumerate(ifiles):
+        # sheets from different directories may share a name
+        sname, ext = os.path.splitext(os.path.basename(ifile))
+        sname = "%d.%s" % (i, sname)
+
+        if ext.lower() == ".pdf" and options.cache:
+            ofile = cached_pdf2tif(ifile, stage_file(tempd, "tif", sname, False), options, stats)
+        elif ext.lower() == ".pdf":
+            ofile = stage_file(tempd, "tif", sname, False)
+            if Verbose:
+                print("Coverting input pdf %s to tif with dpi = %d" % (ifile, options.dpi))
+            with stats.stage("pdf2tif", ofile):
+                pdf2tif(ifile, ofile, options)
+        else:
+            ofile = ifile
+
+        cutline = None
+        if options.autoclip:
+            with stats.stage("find_map_extent"):
+                xoff, yoff, xsize, ysize = map_func.find_map_extent(ofile, options.clip_offset, options.coarse_clip)
+            if Verbose:
+                print("auto clip %s offset (%d,%d) and size (%d,%d)" % (ifile, xoff, yoff, xsize, ysize))
+
+            cfile = stage_file(tempd, "clipped", sname, True)
+            with stats.stage("clip", cfile):
+                clip(ofile, cfile, xoff, yoff, xsize, ysize, False, options, True)
+            ofile = cfile
+        elif options.neatline:
+            cutline = write_cutline(tempd, gdal.Open(ofile).GetMetadata()['NEATLINE'], True, sname)
+
+        wfile = stage_file(tempd, "warped", sname, True)
+        with stats.stage("sheet_warp", wfile):
+            sheet_warp(ofile, wfile, cutline, options)
+        sheets.append(wfile)
+
+    ofile = stage_file(tempd, "mosaic", name, True)
+    with stats.stage("mosaic", ofile):
+        mosaic_vrt(sheets, ofile)
+
+    border = options.border_offset
+    with stats.stage("find_map_trim"):
+        xoff, yoff, xsize, ysize, nx, ny = map_func.find_map_trim(ofile, 0, border)
+    if xoff - border != 0 or yoff - border != 0 or xoff + xsize + border - 1 != nx or yoff + ysize + border - 1 != ny:
+        if Verbose:
+            print("auto clip black border (%d,%d) and size (%d,%d) on image (%d,%d)" % (xoff, yoff, xsize, ysize, nx, ny))
+
+        ifile = ofile
+        ofile = stage_file(tempd, "border", name, True)
+        with stats.stage("clip_border", ofile):
+            clip(ifile, ofile, xoff, yoff, xsize, ysize, False, options, True)
+    elif Verbose:
+        print("a black border does not exist - skipping")
+
+    if options.scale is not None:
+        if Verbose:
+            print("Rescaling image with scale = %s%% and resampling method = %s" % (options.scale, options.resample_alg))
+
+        ifile = ofile
+        ofile = stage_file(tempd, "rescaled", name, True)
+        opt = gdal.TranslateOptions(options="-outsize %d%% %d%% -scale -r %s -of VRT" % (options.scale, options.scale,
+                                                                                      options.resample_alg))
+        with stats.stage("gdalscale", ofile):
+            gdal.Translate(ofile, ifile, options=opt)
+
+    # the tiles are read from the mosaic, warping only the windows they cover
+    stats.set("sheets", len(ifiles))
+    tile_kmz(ofile, kmzfile, tempd, options, stats)
+
+    return finish_stats(stats, options, "ok", tempd)
+
+
+def main(args=None):
     Ifile = False
-    Odir = False
-    Tdir = False
-    Nfile = False
-    Force = False
-    Keep = False
-    AutoClip = False
-    Neatline = False
-    Srcwin = False
-    Projwin = False
-    Verbose = False
+    Lfile = False
     Tiles = False
     Profile = False
-    Scale = False
-    Algorithm = False
-    odir = ""
-    tdir = ""
-    nfile = None
-    btmpdir = None
-    Tif = False
-
-    gps_profiles = {'default': 100, 'etrex': 100, 'montana': 500, 'monterra': 99, 'oregon': 500, 'gpsmap': 500}
-    resample_mthds = ["nearest", "average", "rms", "bilinear", "cubic", "cupicspline", "lanczos", "mode"]
+    Plan = False
+    Mosaic = False
+    Watch = False
+    ifiles = []
+    lfile = None
+    io_profile = {}
+    io_overrides = {}
+    jobs = os.cpu_count() or 1
+    slog = None
+    settle = watch_func.SETTLE_TIME
+    min_free = watch_func.MIN_FREE
+    settings = {}
 
     try:
-        short_args = "-hi:o:fkd:q:cnm:r:vp:s:a:t:MS:b:N:CB:R"
+        short_args = "-hi:o:fkd:q:cnm:r:vp:s:a:t:MS:b:N:CB:RVl:j:w:AW:F"
         long_args = ["help", "input=", "outdir=", "force", "keep", "dpi=", "quality=", "clip", "neatline", "maxtiles=",
                      "maxtileres=", "verbose", "profile=", "scale=", "algorithm=", "tmpdir=", "mintilesize",
                      "squareratio=", "border=", "srcwin=", "projwin=", "nfile=", "convert_to_tif", "black-border=",
-                     "remove-nodata"]
-        opts, args = getopt.getopt(sys.argv[1:], short_args, long_args)
+                     "remove-nodata", "virtual", "list=", "jobs=", "jpeg-workers=", "plan=", "adaptive-quality", "cache=",
+                     "cache-size=", "workdir=", "fused", "pdf-bands=", "band-mem=",
+                     "io-profile=", "blocksize=", "compress=", "predictor=", "bigtiff=", "cachemax=", "num-threads=",
+                     "warp-threads=", "warp-mem=", "warp-error=", "warp-type=", "stats=", "coarse-clip",
+                     "mosaic=", "split", "superoverlay",
+                     "watch=", "status=", "settle=", "min-free="]
+        if args is None:
+            args = sys.argv
+        opts, args = getopt.getopt(args[1:], short_args, long_args)
     except getopt.GetoptError as err:
         Usage()
         print(err)
         return 1
 
+    gps_profiles = {'default': 100, 'etrex': 100, 'montana': 500, 'monterra': 99, 'oregon': 500, 'gpsmap': 500}
+
     for o, a in opts:
         if o in ("-h", "--help"):
             Usage()
             return 0
         elif o in ("-i", "--input"):
             Ifile = True
-            ifile = a
+            ifiles.append(a)
+        elif o in ("-l", "--list"):
+            Lfile = True
+            lfile = a
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+                if jobs < 1:
+                    Usage()
+                    print("jobs must be greater than 0")
+                    return 1
+            except:
+                Usage()
+                print("jobs must be an integer")
+                return 1
         elif o in ("-o", "--outdir"):
-            Odir = True
-            odir = a
+            settings['outdir'] = a
         elif o in ("-t", "--tmpdir"):
-            Tdir = True
-            tdir = a
-        elif o in ("-N", "--neatlinefile"):
-            Nfile = True
-            nfile = a
+            settings['tmpdir'] = a
+        elif o in ("-N", "--nfile"):
+            settings['nfile'] = a
         elif o in ("-f", "--force"):
-            Force = True
+            settings['force'] = True
         elif o in ("-k", "--keep"):
-            Keep = True
+            settings['keep'] = True
+        elif o in ("-V", "--virtual"):
+            settings['virtual'] = True
         elif o in ("-C", "--convert_to_tif"):
-            Tif = True
+            settings['tif'] = True
         elif o in ("-d", "--dpi"):
             try:
-                GDAL_PDF_DPI = int(a)
+                settings['dpi'] = int(a)
+            except:
+                Usage()
+                print("dpi must be an integer")
+                return 1
+        elif o == "--io-profile":
+            if a in io_func.IO_PROFILES:
+                io_profile = io_func.IO_PROFILES[a]
+            else:
+                Usage()
+                print("unknown io profile")
+                print("supported profiles are: %s" % list(io_func.IO_PROFILES.keys()))
+                return 1
+        elif o == "--blocksize":
+            try:
+                io_overrides['tiled'] = True
+                io_overrides['blocksize'] = int(a)
+                if io_overrides['blocksize'] < 16 or io_overrides['blocksize'] % 16 != 0:
+                    Usage()
+                    print("blocksize must be a multiple of 16")
+                    return 1
+            except:
+                Usage()
+                print("blocksize must be an integer")
+                return 1
+        elif o == "--compress":
+            if a.upper() in io_func.COMPRESS_METHODS:
+                io_overrides['compress'] = a.upper()
+            else:
+                Usage()
+                print("invalid compression %s" % io_func.COMPRESS_METHODS)
+                return 1
+        elif o == "--predictor":
+            try:
+                io_overrides['predictor'] = int(a)
+                if io_overrides['predictor'] not in (1, 2):
+                    Usage()
+                    print("predictor must be 1 or 2")
+                    return 1
             except:
                 Usage()
-                print("dpi must be an integer")
+                print("predictor must be an integer")
+                return 1
+        elif o == "--bigtiff":
+            if a.upper() in io_func.BIGTIFF_MODES:
+                io_overrides['bigtiff'] = a.upper()
+            else:
+                Usage()
+                print("invalid bigtiff mode %s" % io_func.BIGTIFF_MODES)
+                return 1
+        elif o == "--cachemax":
+            try:
+                io_overrides['cachemax'] = int(a)
+                if io_overrides['cachemax'] < 1:
+                    Usage()
+                    print("cachemax must be greater than 0")
+                    return 1
+            except:
+                Usage()
+                print("cachemax must be an integer")
+                return 1
+        elif o == "--num-threads":
+            if a.upper() == "ALL_CPUS":
+                io_overrides['threads'] = "ALL_CPUS"
+            else:
+                try:
+                    io_overrides['threads'] = int(a)
+                    if io_overrides['threads'] < 1:
+                        Usage()
+                        print("num-threads must be greater than 0")
+                        return 1
+                except:
+                    Usage()
+                    print("num-threads must be an integer or ALL_CPUS")
+                    return 1
+        elif o == "--pdf-bands":
+            try:
+                settings['pdf_bands'] = int(a)
+                if settings['pdf_bands'] < 1:
+                    Usage()
+                    print("pdf bands must be greater than 0")
+                    return 1
+            except:
+                Usage()
+                print("pdf bands must be an integer")
+                return 1
+        elif o == "--band-mem":
+            try:
+                settings['band_mem'] = int(a)
+                if settings['band_mem'] < 1:
+                    Usage()
+                    print("band memory must be greater than 0")
+                    return 1
+            except:
+                Usage()
+                print("band memory must be an integer")
                 return 1
         elif o in ("-q", "--quality"):
             try:
-                JPEG_QUALITY = int(a)
-                if JPEG_QUALITY < 0 or JPEG_QUALITY > 100:
+                settings['quality'] = int(a)
+                if settings['quality'] < 0 or settings['quality'] > 100:
                     Usage()
                     print("quality must be between 0 and 100")
                     return 1
@@ -262,14 +1560,55 @@ def main(args=None):
                 Usage()
                 print("quality must be an integer")
                 return 1
+        elif o in ("-F", "--fused"):
+            settings['fused'] = True
+        elif o in ("-W", "--workdir"):
+            settings['workdir'] = a
+        elif o == "--stats":
+            settings['stats'] = a
+        elif o == "--mosaic":
+            Mosaic = True
+            mosaic_name = a
+            if not a or os.sep in a:
+                Usage()
+                print("mosaic name must be a file name without a directory")
+                return 1
+        elif o == "--cache":
+            settings['cache'] = a
+        elif o == "--cache-size":
+            try:
+                settings['cache_size'] = int(a)
+                if settings['cache_size'] < 0:
+                    Usage()
+                    print("cache size must be 0 or greater")
+                    return 1
+            except:
+                Usage()
+                print("cache size must be an integer")
+                return 1
+        elif o in ("-A", "--adaptive-quality"):
+            settings['adaptive'] = True
+        elif o in ("-w", "--jpeg-workers"):
+            try:
+                settings['jpeg_workers'] = int(a)
+                if settings['jpeg_workers'] < 1:
+                    Usage()
+                    print("jpeg workers must be greater than 0")
+                    return 1
+            except:
+                Usage()
+                print("jpeg workers must be an integer")
+                return 1
         elif o in ("-c", "--clip"):
-            AutoClip = True
+            settings['autoclip'] = True
+        elif o == "--coarse-clip":
+            settings['autoclip'] = True
+            settings['coarse_clip'] = True
         elif o in ("-n", "--neatline"):
-            Neatline = True
+            settings['neatline'] = True
         elif o == "--srcwin":
-            Srcwin = True
             try:
-                win = np.array(a.split(","), int)
+                win = tuple(int(v) for v in a.split(","))
             except:
                 Usage()
                 print("srcwin must be an integer")
@@ -278,14 +1617,14 @@ def main(args=None):
                 Usage()
                 print("srcwin has 4 arguments")
                 return 1
-            if any(win < 0):
+            if any(v < 0 for v in win):
                 Usage()
                 print("srcwin arguments must be 0 or greater")
                 return 1
+            settings['srcwin'] = win
         elif o == "--projwin":
-            Projwin = True
             try:
-                win = np.array(a.split(","), float)
+                win = tuple(float(v) for v in a.split(","))
             except:
                 Usage()
                 print("projwin must be a float")
@@ -294,31 +1633,43 @@ def main(args=None):
                 Usage()
                 print("projwin has 4 arguments")
                 return 1
-            if any(win < 0):
+            if any(v < 0 for v in win):
                 Usage()
                 print("projwin arguments must be 0 or greater")
                 return 1
+            settings['projwin'] = win
+        elif o == "--plan":
+            Plan = True
+            try:
+                plan_size = [int(v) for v in a.lower().split("x")]
+            except:
+                Usage()
+                print("plan size must be WIDTHxHEIGHT")
+                return 1
+            if len(plan_size) != 2 or min(plan_size) < 1:
+                Usage()
+                print("plan size must be WIDTHxHEIGHT")
+                return 1
         elif o in ("-m", "--maxtiles"):
             Tiles = True
-            MAX_TILES = int(a)
+            settings['max_tiles'] = int(a)
         elif o in ("-r", "--maxtileres"):
-            MAX_TILE_RES = int(a)
+            settings['max_tile_res'] = int(a)
         elif o in ("-v", "--verbose"):
-            Verbose = True
+            settings['verbose'] = True
         elif o in ("-p", "--profile"):
             Profile = True
             if a in gps_profiles:
-                MAX_TILES = int(gps_profiles[a])
+                settings['max_tiles'] = int(gps_profiles[a])
             else:
                 Usage()
                 print("unknown gps profile")
                 print("supported profiles are: %s" % list(gps_profiles.keys()))
                 return 1
         elif o in ("-s", "--scale"):
-            Scale = True
             try:
-                IMAGE_SCALE = int(a)
-                if IMAGE_SCALE < 0:
+                settings['scale'] = int(a)
+                if settings['scale'] < 0:
                     Usage()
                     print("quality must be greater than 0")
                     return 1
@@ -327,21 +1678,51 @@ def main(args=None):
                 print("image scale must be an integer")
                 return 1
         elif o in ("-a", "--algorithm"):
-            Algorithm = True
-            RESAMPLE_ALG = a
+            settings['resample_alg'] = a
+        elif o == "--watch":
+            Watch = True
+            wdir = a
+        elif o == "--status":
+            slog = a
+        elif o == "--settle":
+            try:
+                settle = float(a)
+                if settle < 0:
+                    Usage()
+                    print("settle time must be 0 or greater")
+                    return 1
+            except:
+                Usage()
+                print("settle time must be a number")
+                return 1
+        elif o == "--min-free":
+            try:
+                min_free = int(a)
+                if min_free < 0:
+                    Usage()
+                    print("minimum free space must be 0 or greater")
+                    return 1
+            except:
+                Usage()
+                print("minimum free space must be an integer")
+                return 1
+        elif o == "--split":
+            settings['split'] = True
+        elif o == "--superoverlay":
+            settings['superoverlay'] = True
         elif o in ("-M", "--mintilesize"):
-            SORT_DIR = 1
+            settings['sort_dir'] = 1
         elif o in ("-S", "--squareratio"):
             try:
-                SQUARE_RATIO = float(a)
+                settings['square_ratio'] = float(a)
             except:
                 Usage()
                 print("squareratio must be a float")
                 return 1
         elif o in ("-b", "--border"):
             try:
-                CLIP_OFFSET = int(a)
-                if CLIP_OFFSET < 0:
+                settings['clip_offset'] = int(a)
+                if settings['clip_offset'] < 0:
                     Usage()
                     print("auto clip border offset must be greater than 0")
                     return 1
@@ -351,8 +1732,8 @@ def main(args=None):
                 return 1
         elif o in ("-B", "--black-border"):
             try:
-                BORDER_OFFSET = int(a)
-                if BORDER_OFFSET < 0:
+                settings['border_offset'] = int(a)
+                if settings['border_offset'] < 0:
                     Usage()
                     print("black border offset must be greater than 0")
                     return 1
@@ -361,345 +1742,153 @@ def main(args=None):
                 print("black border offset must be an integer")
                 return 1
         elif o in ("-R", "--remove-nodata"):
-            WARP_NODATA = "None"
-        else:
-            Usage()
-            print("unknown option", o, a)
-            return 1
-
-    if not Ifile:
-        Usage()
-        print("option [-i|--input] required")
-        return 1
-    else:
-        if Verbose:
-            print("Input file = %s" % ifile)
-
-    if Nfile:
-        if not os.path.isfile(nfile):
-            Usage()
-            print("neatline file does not exist: %s" % nfile)
-            return 1
-
-    if (AutoClip and Srcwin) or (AutoClip and Projwin) or (Srcwin and Projwin):
-        Usage()
-        print("only specify one clipping option")
-        return 1
-
-    if (Neatline and Srcwin) or (Neatline and Projwin) or (Neatline and AutoClip):
-        Usage()
-        print("only specify one clipping option")
-        return 1
-
-    if (Nfile and Srcwin) or (Nfile and Projwin) or (Nfile and Neatline) or (Nfile and AutoClip):
-        Usage()
-        print("only specify one clipping option")
-        return 1
-
-    if Tiles and Profile:
-        Usage()
-        print("gps profile cannot be specified with maxtiles")
-        return 1
-
-    if Algorithm:
-        if not RESAMPLE_ALG in resample_mthds:
-            Usage()
-            print("invalid resampling algorithm %s" % resample_mthds)
-            return 1
-
-    if not Odir:
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        odir = os.path.dirname(os.path.realpath(ifile))
-    else:
-        if os.path.isdir(odir):
-            name, ext = os.path.splitext(os.path.basename(ifile))
-        else:
+            settings['nodata'] = "None"
+        elif o == "--warp-threads":
+            if a.upper() == "ALL_CPUS":
+                settings['warp_threads'] = "ALL_CPUS"
+            else:
+                try:
+                    settings['warp_threads'] = int(a)
+                    if settings['warp_threads'] < 1:
+                        Usage()
+                        print("warp threads must be greater than 0")
+                        return 1
+                except:
+                    Usage()
+                    print("warp threads must be an integer or ALL_CPUS")
+                    return 1
+        elif o == "--warp-mem":
             try:
-                os.mkdir(odir)
-                name, ext = os.path.splitext(os.path.basename(ifile))
-            except:
-                Usage()
-                print("cannot create output directory")
-                return 1
-
-    if Verbose:
-        print("Output directory = %s" % odir)
-
-    if not Tif:
-        kmzfile = odir + os.sep + name + ".kmz"
-        if os.path.exists(kmzfile):
-            if os.path.isfile(kmzfile):
-                if not Force:
+                settings['warp_memory'] = int(a)
+                if settings['warp_memory'] < 1:
                     Usage()
-                    print("output file %s exists, -f to force overwrite" % kmzfile)
+                    print("warp memory must be greater than 0")
                     return 1
-            else:
+            except:
                 Usage()
-                print("output file %s exists but is not a regular file" % kmzfile)
+                print("warp memory must be an integer")
                 return 1
-
-    if Tif:
-        ofile = odir + os.sep + name + ".tif"
-        if os.path.exists(ofile):
-            if os.path.isfile(ofile):
-                if not Force:
+        elif o == "--warp-error":
+            try:
+                settings['warp_error'] = float(a)
+                if settings['warp_error'] < 0:
                     Usage()
-                    print("output file %s exists, -f to force overwrite" % ofile)
+                    print("warp error must be 0 or greater")
                     return 1
-            else:
+            except:
                 Usage()
-                print("output file %s exists but is not a regular file" % ofile)
+                print("warp error must be a float")
                 return 1
-    else:
-        if Tdir:
-            if os.path.isdir(tdir):
-                btmpdir = os.path.realpath(tdir)
+        elif o == "--warp-type":
+            if a in warp_types:
+                settings['warp_type'] = a
             else:
                 Usage()
-                print("temporary directory base is not an existing directory")
+                print("invalid warp type %s" % warp_types)
                 return 1
-
-        ""
-        tempd = create_tempdir(name, btmpdir)
-
-        if Verbose:
-            print("Temporary directory: %s" % tempd)
-
-    if ext.lower() == ".pdf":
-        if not Tif:
-            path = tempd + os.sep + "tif"
-            if not os.path.isdir(path):
-                os.mkdir(path)
-            ofile = path + os.sep + name + ".tif"
-
-        if Verbose:
-            print("Coverting input pdf to tif with dpi = %d" % GDAL_PDF_DPI)
-
-        pdf2tif(ifile, ofile)
-
-        if Tif:
+        else:
+            Usage()
+            print("unknown option", o, a)
             return 1
-    elif ext.lower() in (".tif", ".tiff"):
-        if Verbose:
-            if Tif:
-                print("Input file already in tif format: %s" % ifile)
-                return 1
-            else:
-                print("Input file in tif format: %s" % ifile)
-        ofile = ifile
-
-    if AutoClip:
-        ifile = ofile
-        path = tempd + os.sep + "clipped"
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = path + os.sep + name + ext
-
-        if Verbose:
-            print("Using auto clip with offset=%d" % CLIP_OFFSET)
-
-        xoff, yoff, xsize, ysize = map_func.find_map_extent(ifile, CLIP_OFFSET)
-
-        if Verbose:
-            print("auto clip offset (%d,%d) and size (%d,%d)" % (xoff, yoff, xsize, ysize))
-
-        clip(ifile, ofile, xoff, yoff, xsize, ysize, False)
-    elif Srcwin:
-        ifile = ofile
-        path = tempd + os.sep + "clipped"
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = path + os.sep + name + ext
-        xoff, yoff, xsize, ysize = win
-
-        if Verbose:
-            if Projwin:
-                print("clip using projwin offset (%d %d) and size (%d %d)" % (xoff, yoff, xsize, ysize))
-            else:
-                print("clip using srcwin offset (%d %d) and size (%d %d)" % (xoff, yoff, xsize, ysize))
-
-        clip(ifile, ofile, xoff, yoff, xsize, ysize, Projwin)
-
-    if Projwin:
-        ifile = ofile
-        path = tempd + os.sep + "rotated"
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        ofile = path + os.sep + name + ".tif"
-
-        if Verbose:
-            print("Removing rotation from input file")
-
-        remove_rotation(ifile, ofile)
-
-    if Neatline:
-        ifile = ofile
-        path = tempd + os.sep + "clipped"
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = path + os.sep + name + ext
-
-        if Verbose:
-            print("Using neatline to clip")
-
-        clipbycutline(ifile, ofile, tempd, nfile)
-    elif Nfile:
-        ifile = ofile
-        path = tempd + os.sep + "clipped"
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = path + os.sep + name + ext
-
-        if Verbose:
-            print("Using neatline csv file to clip")
-
-        clipbycutline(ifile, ofile, tempd, nfile)
-    elif Projwin:
-        ifile = ofile
-        path = tempd + os.sep + "clipped"
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = path + os.sep + name + ext
-        xoff, yoff, xsize, ysize = win
-
-        if Verbose:
-            if Projwin:
-                print("clip using projwin offset (%d %d) and size (%d %d)" % (xoff, yoff, xsize, ysize))
-            else:
-                print("clip using srcwin offset (%d %d) and size (%d %d)" % (xoff, yoff, xsize, ysize))
-
-        clip(ifile, ofile, xoff, yoff, xsize, ysize, Projwin)
-
-    ifile = ofile
-    path = tempd + os.sep + "warped"
-    if not os.path.isdir(path):
-        os.mkdir(path)
-    name, ext = os.path.splitext(os.path.basename(ifile))
-    ofile = path + os.sep + name + ext
-
-    if Verbose:
-        print("Running gdalwarp")
-
-    gdalwarp(ifile, ofile, WARP_NODATA)
-
-    xoff, yoff, xsize, ysize, nx, ny = map_func.find_map_trim(ofile, 0, BORDER_OFFSET)
-    if xoff - BORDER_OFFSET != 0 or yoff - BORDER_OFFSET != 0 or xoff + xsize + BORDER_OFFSET - 1 != nx or yoff + ysize + BORDER_OFFSET - 1 != ny:
-        ifile = ofile
-        path = tempd + os.sep + "border"
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = path + os.sep + name + ext
 
-        if Verbose:
-            print("auto clip black border (%d,%d) and size (%d,%d) on image (%d,%d)" % (xoff, yoff, xsize, ysize, nx, ny))
+    if Tiles and Profile:
+        Usage()
+        print("gps profile cannot be specified with maxtiles")
+        return 1
 
-        clip(ifile, ofile, xoff, yoff, xsize, ysize, False)
-    else:
-        if Verbose:
-            print("a black border does not exist - skipping")
+    # explicit options override the io profile whatever their order
+    io_profile = dict(io_profile)
+    io_profile.update(io_overrides)
+    settings['creation_options'] = tuple(io_func.creation_options(io_profile))
+    settings['cachemax'] = io_profile.get('cachemax')
+    settings['num_threads'] = io_profile.get('threads')
+    options = Options(**settings)
 
-    if Scale:
-        ifile = ofile
-        path = tempd + os.sep + "rescaled"
-        if not os.path.isdir(path):
-            os.mkdir(path)
+    if Plan:
+        return print_plan(plan_size[0], plan_size[1], options)
 
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = path + os.sep + name + ext
+    if Watch:
+        if Ifile or Lfile or Mosaic:
+            Usage()
+            print("watch cannot be combined with -i, -l or --mosaic")
+            return 1
 
-        if Verbose:
-            print("Rescaling image with scale = %s%% and resampling method = %s" % (IMAGE_SCALE, RESAMPLE_ALG))
+        if not os.path.isdir(wdir):
+            Usage()
+            print("watch directory does not exist: %s" % wdir)
+            return 1
 
-        gdalscale(ifile, ofile, IMAGE_SCALE, RESAMPLE_ALG)
+        if options.outdir and not os.path.isdir(options.outdir):
+            try:
+                os.makedirs(options.outdir, exist_ok=True)
+            except OSError:
+                Usage()
+                print("cannot create output directory")
+                return 1
 
-    path = tempd + os.sep + "tiled"
-    if not os.path.isdir(path):
-        os.mkdir(path)
+        if slog is None:
+            slog = os.path.join(options.outdir or wdir, "pdf2kmz-status.log")
 
-    if Verbose:
-        print("Maximum number of tiles = %d" % MAX_TILES)
-        print("Maximum tile resolution = %d" % MAX_TILE_RES)
+        return watch_func.run_watch(wdir, options, jobs, slog, settle, min_free)
 
-    ts = tile_func.get_tile_size(ofile, MAX_TILES, MAX_TILE_RES, SORT_DIR, SQUARE_RATIO)
-    if ts == None:
+    if not Ifile and not Lfile:
         Usage()
-        print("tiling not found")
-        cleanup_tempdir(tempd, Keep)
+        print("option [-i|--input] required")
         return 1
-    else:
-        if Verbose:
-            print("retiling with %dx%d tile" % (ts[3], ts[4]))
-        gdalretile(ofile, path, ts[3], ts[4])
 
-        if Verbose:
-            print("retiled with %d tiles (%dx%d)" % (ts[2], ts[0], ts[1]))
-
-    opath = path + os.sep + "files"
-    if not os.path.isdir(opath):
-        os.mkdir(opath)
+    if Lfile and not os.path.isfile(lfile):
+        Usage()
+        print("input list file does not exist: %s" % lfile)
+        return 1
 
-    if Verbose:
-        print("Converting tiled tif files to jpeg with a quality of %s" % JPEG_QUALITY)
+    if Mosaic:
+        inputs = batch_func.find_inputs(ifiles, lfile)
+        if len(inputs) == 0:
+            Usage()
+            print("no input files found")
+            return 1
 
-    tif2jpg(path, opath, MAX_JPEG_SIZE)
+        try:
+            convert_mosaic(inputs, mosaic_name, options)
+        except ConvertError as err:
+            Usage()
+            print(err)
+            return 1
 
-    if Verbose:
-        print("Generating kml file")
+        return 0
 
-    genkml_func.genkml(path, 4326)
+    if Lfile or len(ifiles) > 1 or os.path.isdir(ifiles[0]) or glob.has_magic(ifiles[0]):
+        inputs = batch_func.find_inputs(ifiles, lfile)
+        if len(inputs) == 0:
+            Usage()
+            print("no input files found")
+            return 1
 
-    if Verbose:
-        print("Generating kmz = %s" % kmzfile)
+        if options.outdir and not os.path.isdir(options.outdir):
+            try:
+                os.mkdir(options.outdir)
+            except:
+                Usage()
+                print("cannot create output directory")
+                return 1
 
-    genkmz_func.genkmz(kmzfile, path)
+        return batch_func.run_batch(inputs, options, jobs)
 
-    cleanup_tempdir(tempd, Keep)
+    try:
+        convert(ifiles[0], options)
+    except ConvertError as err:
+        Usage()
+        print(err)
+        return 1
 
     return 0
 
 
-# Global vars
-###############################################################################
-# Copy and paste from gdal_retile.py - see LICENSE file
-###############################################################################
-Verbose = False
-Quiet = False
-CreateOptions = []
-Names = []
-TileWidth = 256
-TileHeight = 256
-Overlap = 0
-Format = 'GTiff'
-BandType = None
-Driver = None
-Extension = None
-MemDriver = None
-TileIndexFieldName = 'location'
-TileIndexName = None
-TileIndexDriverTyp = "Memory"
-CsvDelimiter = ";"
-CsvFileName = None
-Source_SRS = None
-TargetDir = None
-ResamplingMethod = gdal.GRA_NearestNeighbour
-Levels = 0
-PyramidOnly = False
-LastRowIndx = -1
-UseDirForEachRow = False
-###############################################################################
-
-# Global vars
+# Default settings
 GDAL_PDF_DPI = 250
 JPEG_QUALITY = 80
 MAX_TILES = 100
 MAX_TILE_RES = 1048576
-IMAGE_SCALE = 100
 RESAMPLE_ALG = "lanczos"
 SORT_DIR = -1
 SQUARE_RATIO = 1.2
@@ -707,6 +1896,50 @@ MAX_JPEG_SIZE = 3000000
 CLIP_OFFSET = 5
 BORDER_OFFSET = 5
 WARP_NODATA = None
+JPEG_WORKERS = os.cpu_count() or 1
+PDF_BANDS = 1
+PDF_BAND_MEM = 0
+# rows rendered past each edge of a pdf band and cropped off, the renderer's
+# anti-aliasing and image smoothing reach a few pixels past the edge of a window
+# so this is a wide margin, benchmark.py reports whether it is needed
+PDF_BAND_OVERLAP = 16
+# from the gdalwarp sweep of benchmark.py, batch and watch workers cap it to their share of the cpus
+WARP_THREADS = "ALL_CPUS"
+WARP_MEMORY = None
+WARP_ERROR = None
+WARP_TYPE = None
+
+# settings of a conversion, immutable so one options object can be shared by
+# any number of conversions, change a copy with options._replace(...)
+#   scale: percentage to rescale the final image by, None to keep its size
+#   srcwin, projwin: (xoff, yoff, xsize, ysize) and (ulx, uly, lrx, lry) clip windows
+#   nfile: neatline csv file to clip with
+#   creation_options: GeoTIFF creation options of the intermediate rasters
+#   cachemax, num_threads: gdal block cache (MB) and worker threads, None for gdal's own
+#   stats: file to write the stats report to
+#   split: split an image with no tiling into parts that each have one
+#   superoverlay: write a region based tile pyramid instead of the flat device layout
+Options = collections.namedtuple("Options", [
+    "verbose", "outdir", "tmpdir", "force", "keep", "virtual", "workdir", "tif", "stats",
+    "dpi", "pdf_bands", "band_mem", "cache", "cache_size",
+    "autoclip", "coarse_clip", "clip_offset", "neatline", "nfile", "srcwin", "projwin", "border_offset",
+    "nodata", "warp_threads", "warp_memory", "warp_error", "warp_type", "fused",
+    "scale", "resample_alg",
+    "quality", "adaptive", "jpeg_workers", "max_jpeg_size",
+    "max_tiles", "max_tile_res", "sort_dir", "square_ratio", "split", "superoverlay",
+    "creation_options", "cachemax", "num_threads"])
+Options.__new__.__defaults__ = (
+    False, None, None, False, False, False, None, False, None,
+    GDAL_PDF_DPI, PDF_BANDS, PDF_BAND_MEM, None, cache_func.CACHE_SIZE,
+    False, False, CLIP_OFFSET, False, None, None, None, BORDER_OFFSET,
+    WARP_NODATA, WARP_THREADS, WARP_MEMORY, WARP_ERROR, WARP_TYPE, False,
+    None, RESAMPLE_ALG,
+    JPEG_QUALITY, False, JPEG_WORKERS, MAX_JPEG_SIZE,
+    MAX_TILES, MAX_TILE_RES, SORT_DIR, SQUARE_RATIO, False, False,
+    (), None, None)
+
+# output file (a list of kmz files when split) and stats report of a conversion
+Result = collections.namedtuple("Result", ["output", "report"])
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+
+MANIFEST = "manifest.json"
+
+
+# record of the pipeline stages built in a persistent work directory, a stage is
+# up to date when its key, made from its parameters and the key of the stage it
+# reads from, matches the recorded key and its output still exists
+# without a work directory nothing is ever up to date and nothing is recorded
+class Manifest:
+    def __init__(self, workdir=None):
+        self.workdir = workdir
+        self.stages = {}
+        self.visited = set()
+
+        if workdir is not None:
+            mfile = os.path.join(workdir, MANIFEST)
+            if os.path.isfile(mfile):
+                try:
+                    with open(mfile) as fh:
+                        self.stages = json.load(fh)["stages"]
+                except (ValueError, KeyError):
+                    self.stages = {}
+
+    # key of an input file, from its path, size and modification time
+    def source_key(self, ifile):
+        st = os.stat(ifile)
+        return self.key("source", None, {"file": os.path.realpath(ifile), "size": st.st_size,
+                                         "mtime": st.st_mtime})
+
+    def key(self, stage, prev, params):
+        text = json.dumps([stage, prev, params], sort_keys=True)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def fresh(self, stage, key, ofile):
+        if self.workdir is None:
+            return False
+
+        entry = self.stages.get(stage)
+        if entry is None or entry["key"] != key or not os.path.exists(ofile):
+            return False
+
+        self.visited.add(stage)
+        return True
+
+    # recorded output of a stage, None if it has not been built
+    def output(self, stage):
+        entry = self.stages.get(stage)
+        if entry is None:
+            return None
+        return entry["ofile"]
+
+    # record a rebuilt stage, every stage not yet visited in this run is
+    # downstream of it and is dropped along with its files in the work directory
+    def record(self, stage, key, ofile):
+        if self.workdir is None:
+            return
+
+        # a stage may pass its input through as its output
+        keep = set(self.stages[name]["ofile"] for name in self.visited if name in self.stages)
+        keep.add(ofile)
+
+        for name in list(self.stages):
+            if name in self.visited or name == stage:
+                continue
+            if self.stages[name]["ofile"] not in keep:
+                self.remove_output(self.stages[name]["ofile"])
+            del self.stages[name]
+
+        self.stages[stage] = {"key": key, "ofile": ofile}
+        self.visited.add(stage)
+        self.save()
+
+    def remove_output(self, ofile):
+        workdir = os.path.realpath(self.workdir)
+        if os.path.isfile(ofile) and os.path.realpath(ofile).startswith(workdir + os.sep):
+            os.remove(ofile)
+
+    def save(self):
+        mfile = os.path.join(self.workdir, MANIFEST)
+        tmpfile = mfile + ".tmp"
+        with open(tmpfile, "w") as fh:
+            json.dump({"stages": self.stages}, fh, indent=1, sort_keys=True)
+        os.replace(tmpfile, mfile)
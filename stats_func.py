@@ -0,0 +1,110 @@
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# peak resident memory in bytes of this process and of its finished children,
+# a high-water mark since the process started, not of the current conversion
+def peak_rss():
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+# bytes of each subdirectory of a directory, files directly in it are under "."
+def dir_bytes(tempd):
+    sizes = {}
+    for root, dirs, files in os.walk(tempd):
+        rel = os.path.relpath(root, tempd)
+        sub = rel.split(os.sep)[0]
+        for filename in files:
+            fname = os.path.join(root, filename)
+            if os.path.isfile(fname):
+                sizes[sub] = sizes.get(sub, 0) + os.path.getsize(fname)
+
+    return sizes
+
+
+# timing, memory and output statistics of one conversion
+class Stats:
+    def __init__(self, ifile):
+        self.report = {"input": ifile, "status": "running", "stages": []}
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    # time a stage, with ofile the size of the raster it produced is recorded
+    @contextlib.contextmanager
+    def stage(self, name, ofile=None):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        yield
+        entry = {"name": name, "wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu}
+
+        if ofile is not None:
+            from osgeo import gdal
+
+            src = gdal.Open(ofile)
+            if src is not None:
+                entry["raster"] = [src.RasterXSize, src.RasterYSize]
+            del src
+
+        self.report["stages"].append(entry)
+
+    def set(self, key, value):
+        self.report[key] = value
+
+    # final report, with the bytes still in the temp directory before cleanup
+    # a worker converting several files reports the same process peak memory
+    # for each of them once it has been reached
+    def finish(self, status, tempd=None):
+        self.report["status"] = status
+        self.report["wall"] = time.perf_counter() - self.wall
+        self.report["cpu"] = time.process_time() - self.cpu
+        self.report["process_peak_rss"], self.report["process_peak_rss_children"] = peak_rss()
+        if tempd is not None and os.path.isdir(tempd):
+            self.report["temp_bytes_left"] = dir_bytes(tempd)
+
+        return self.report
+
+
+def write(report, ofile):
+    with open(ofile, 'w') as fh:
+        json.dump(report, fh, indent=1)
+        fh.write("\n")
+
+
+# totals over the reports of a batch
+def aggregate(reports):
+    summary = {"files": len(reports), "ok": 0, "failed": 0, "wall": 0.0, "cpu": 0.0, "tiles": 0,
+               "jpeg_bytes": 0, "process_peak_rss": 0, "stages": {}}
+
+    for report in reports:
+        if report.get("status") == "ok":
+            summary["ok"] += 1
+        else:
+            summary["failed"] += 1
+
+        summary["wall"] += report.get("wall", 0.0)
+        summary["cpu"] += report.get("cpu", 0.0)
+        summary["tiles"] += report.get("tiles", 0)
+        summary["jpeg_bytes"] += sum(report.get("jpeg_bytes", []))
+        summary["process_peak_rss"] = max(summary["process_peak_rss"], report.get("process_peak_rss") or 0)
+
+        for entry in report.get("stages", []):
+            total = summary["stages"].setdefault(entry["name"], {"count": 0, "wall": 0.0, "cpu": 0.0})
+            total["count"] += 1
+            total["wall"] += entry["wall"]
+            total["cpu"] += entry["cpu"]
+
+    return {"summary": summary, "files": reports}
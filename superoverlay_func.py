@@ -0,0 +1,218 @@
+import collections
+import concurrent.futures
+
+import numpy as np
+from osgeo import gdal
+
+import genkml_func
+import tile_func
+
+# width and height in pixels of the tiles of every level
+TILE_SIZE = 256
+
+# pixels on screen a tile's region needs before the tile (and its jpeg) loads
+MIN_LOD_PIXELS = 128
+
+
+# number of levels of a pyramid whose coarsest level is a single tile
+def levels(xp, yp, tsize=TILE_SIZE):
+    n = 1
+    while tsize << (n - 1) < max(xp, yp):
+        n += 1
+
+    return n
+
+
+# bands, rows, columns rgb array of a window, paletted and gray rasters expanded
+def read_rgb(ds, xoff, yoff, xsize, ysize):
+    if ds.RasterCount >= 3:
+        bands = [ds.GetRasterBand(i).ReadAsArray(xoff, yoff, xsize, ysize) for i in (1, 2, 3)]
+        return np.clip(np.stack(bands), 0, 255).astype(np.uint8)
+
+    band = ds.GetRasterBand(1)
+    arr = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    ct = band.GetColorTable()
+    if ct is not None:
+        pal = np.zeros((256, 3), np.uint8)
+        for i in range(min(ct.GetCount(), 256)):
+            pal[i] = ct.GetColorEntry(i)[:3]
+        return np.moveaxis(pal[arr], 2, 0)
+
+    arr = np.clip(arr, 0, 255).astype(np.uint8)
+    return np.stack([arr, arr, arr])
+
+
+# average of each 2x2 block, an odd last row or column is averaged with itself
+def halve(arr):
+    if arr.shape[1] % 2:
+        arr = np.concatenate([arr, arr[:, -1:]], axis=1)
+    if arr.shape[2] % 2:
+        arr = np.concatenate([arr, arr[:, :, -1:]], axis=2)
+
+    a = arr.astype(np.uint16)
+    return ((a[:, 0::2, 0::2] + a[:, 1::2, 0::2] + a[:, 0::2, 1::2] + a[:, 1::2, 1::2] + 2) // 4).astype(np.uint8)
+
+
+# jpeg of an rgb array, (jpeg bytes, quality) as tile_func.fit_jpeg
+def encode_array(arr, quality, maxsize):
+    bands, ysize, xsize = arr.shape
+    mem = gdal.GetDriverByName("MEM").Create("", xsize, ysize, bands, gdal.GDT_Byte)
+    for i in range(bands):
+        mem.GetRasterBand(i + 1).WriteArray(arr[i])
+
+    return tile_func.fit_jpeg(mem, 0, 0, xsize, ysize, quality, maxsize)
+
+
+def region_kml(box, min_lod):
+    return """<Region>
+<LatLonAltBox>
+<north>%.15g</north>
+<south>%.15g</south>
+<east>%.15g</east>
+<west>%.15g</west>
+</LatLonAltBox>
+<Lod>
+<minLodPixels>%d</minLodPixels>
+<maxLodPixels>-1</maxLodPixels>
+</Lod>
+</Region>""" % (box + (min_lod,))
+
+
+# kml of one tile, its overlay drawn over the coarser levels and a network link
+# to each child loaded only once the child's region is large enough on screen
+def tile_kml(tname, level, box, children):
+    n, s, e, w = box
+    if level == 0:
+        min_lod = 0
+    else:
+        min_lod = MIN_LOD_PIXELS
+
+    kml = ["""<?xml version="1.0" encoding="utf-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+<name>%s</name>
+%s
+<GroundOverlay>
+<drawOrder>%d</drawOrder>
+<Icon>
+<href>%s.jpg</href>
+</Icon>
+<LatLonBox>
+<north>%.15g</north>
+<south>%.15g</south>
+<east>%.15g</east>
+<west>%.15g</west>
+</LatLonBox>
+</GroundOverlay>"""
+           % (tname, region_kml(box, min_lod), level + 1, tname, n, s, e, w)]
+
+    for cname, cbox in children:
+        kml.append("""
+<NetworkLink>
+<name>%s</name>
+%s
+<Link>
+<href>%s.kml</href>
+<viewRefreshMode>onRegion</viewRefreshMode>
+</Link>
+</NetworkLink>""" % (cname, region_kml(cbox, MIN_LOD_PIXELS), cname))
+
+    kml.append("""
+</Document>
+</kml>""")
+
+    return "".join(kml).encode("utf-8")
+
+
+# root kml of the kmz, linking to the coarsest tile
+def doc_kml(name, root):
+    return ("""<?xml version="1.0" encoding="utf-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+<name>%s</name>
+<NetworkLink>
+<name>%s</name>
+<Link>
+<href>files/%s.kml</href>
+</Link>
+</NetworkLink>
+</Document>
+</kml>""" % (name, name, root)).encode("utf-8")
+
+
+# name of the tile x, y of a level
+def tile_name(level, x, y):
+    return "%d_%d_%d" % (level, x, y)
+
+
+# kml and jpeg entries of a superoverlay pyramid of a raster, yields (archive
+# name, bytes, jpeg quality or None for the kml), the root tile is
+# tile_name(0, 0, 0)
+# the pyramid is walked depth first: every full resolution window is read
+# once and each coarser tile is averaged from its children, so only the tiles
+# on the path to the current one are held in memory
+def gen_superoverlay(ifile, quality, workers=1, maxsize=None, tsize=TILE_SIZE):
+    src = gdal.Open(ifile)
+    xp = src.RasterXSize
+    yp = src.RasterYSize
+    gt = src.GetGeoTransform()
+    transform = genkml_func.get_transform(src.GetProjection(), 4326)
+    maxlevel = levels(xp, yp, tsize) - 1
+
+    def window(level, x, y):
+        span = tsize << (maxlevel - level)
+        xoff = x * span
+        yoff = y * span
+        return xoff, yoff, min(span, xp - xoff), min(span, yp - yoff)
+
+    def bounds(level, x, y):
+        ulx, uly, lrx, lry = tile_func.tile_bounds(gt, *window(level, x, y))
+        points = transform.TransformPoints([(ulx, uly), (lrx, lry)])
+        w, n = points[0][:2]
+        e, s = points[1][:2]
+        return n, s, e, w
+
+    pending = collections.deque()
+
+    def walk(executor, level, x, y):
+        if level == maxlevel:
+            arr = read_rgb(src, *window(level, x, y))
+            children = []
+        else:
+            span = tsize << (maxlevel - level - 1)
+            children = []
+            rows = []
+            for cy in (2 * y, 2 * y + 1):
+                if cy * span >= yp:
+                    continue
+                row = []
+                for cx in (2 * x, 2 * x + 1):
+                    if cx * span >= xp:
+                        continue
+                    carr = yield from walk(executor, level + 1, cx, cy)
+                    row.append(carr)
+                    children.append((tile_name(level + 1, cx, cy), bounds(level + 1, cx, cy)))
+                rows.append(np.concatenate(row, axis=2))
+            arr = halve(np.concatenate(rows, axis=1))
+
+        tname = tile_name(level, x, y)
+        yield "files/" + tname + ".kml", tile_kml(tname, level, bounds(level, x, y), children), None
+
+        pending.append((tname, executor.submit(encode_array, arr, quality, maxsize)))
+        while len(pending) >= 2 * workers:
+            yield result_tile(*pending.popleft())
+
+        return arr
+
+    # gdal releases the GIL while encoding, only a few tiles are encoded ahead
+    # of the consumer so memory stays bounded
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, initializer=tile_func.init_thread) as executor:
+        yield from walk(executor, 0, 0, 0)
+
+        while pending:
+            yield result_tile(*pending.popleft())
+
+
+def result_tile(tname, future):
+    data, quality = future.result()
+    return "files/" + tname + ".jpg", data, quality
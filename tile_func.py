@@ -1,52 +1,277 @@
-import sys
+import bisect
+import collections
+import concurrent.futures
+import threading
+import uuid
 
-from osgeo import gdal
+# most parts a raster is split into when it has no tiling of its own
+MAX_PARTS = 64
 
 
+# tiling candidate, the first nine fields are the historical get_tile_size tuple
+Tiling = collections.namedtuple("Tiling", ["xt", "yt", "ntiles", "xtile", "ytile", "npix", "xp", "yp", "area",
+                                           "aspect", "waste"])
+
+
+class TilingError(ValueError):
+    pass
+
+
+# distinct tile sizes ceil(xp / div) in decreasing order, stepping over the runs
+# of divisors that give the same size
 def find_tiles(xp, xtiles):
+    if xp <= 1:
+        return
+
+    n = xp - 1
     div = 1
-    xt = xp
-    xtl = -1
-    while xt > 1:
-        xt = xp // div + (xp % div > 0)
-        if xt != xtl:
-            xtiles.append(xt)
-        div = div + 1
-        xtl = xt
+    while True:
+        q = n // div
+        xtiles.append(q + 1)
+        if q == 0:
+            break
+        div = n // q + 1
 
 
-def get_tile_size(filename, maxtiles, maxres, sort_dir, square_ratio):
-    src = gdal.Open(filename)
-    xp = src.RasterXSize
-    yp = src.RasterYSize
+def ceil_div(a, b):
+    return a // b + (a % b > 0)
+
 
+# ranked tilings of a xp by yp raster, best first
+def plan_tiles(xp, yp, maxtiles, maxres, sort_dir=-1, square_ratio=1.2):
     xtiles = []
     ytiles = []
     find_tiles(xp, xtiles)
     find_tiles(yp, ytiles)
 
-    cnt = 0
+    # ytiles is decreasing, search it by its negation
+    neg_ytiles = [-ytile for ytile in ytiles]
+
     tiles = []
     for xtile in xtiles:
-        xt = xp // xtile + (xp % xtile > 0)
+        xt = ceil_div(xp, xtile)
         if xt * xtile < xp:
-            sys.exit()
+            raise TilingError("tile width %d does not cover %d pixels" % (xtile, xp))
+
+        maxyt = maxtiles // xt
+        if maxyt < 1 or maxres <= xtile or square_ratio <= 0:
+            continue
 
-        for ytile in ytiles:
+        # contiguous range of tile heights that can satisfy the limits, the
+        # exact tests below decide the (exclusive, floating point) edges
+        lo = max(ceil_div(yp, maxyt), int(xtile / square_ratio) - 1)
+        hi = min((maxres - 1) // xtile, int(square_ratio * xtile) + 1)
+        if lo > hi:
+            continue
+
+        for ytile in ytiles[bisect.bisect_left(neg_ytiles, -hi):bisect.bisect_right(neg_ytiles, -lo)]:
             np = xtile * ytile
-            yt = yp // ytile + (yp % ytile > 0)
+            yt = ceil_div(yp, ytile)
 
             if yt * ytile < yp:
-                sys.exit()
+                raise TilingError("tile height %d does not cover %d pixels" % (ytile, yp))
 
             if np < maxres and xtile < square_ratio * ytile and ytile < square_ratio * xtile and xt * yt <= maxtiles:
-                tiles.append((xt, yt, xt * yt, xtile, ytile, np, xp, yp, xp * yp))
+                tiles.append(Tiling(xt, yt, xt * yt, xtile, ytile, np, xp, yp, xp * yp,
+                                    max(xtile, ytile) / min(xtile, ytile), xt * yt * np - xp * yp))
+
+    tiles.sort(key=lambda x: sort_dir * x.npix)
+
+    return tiles
+
+
+# offsets and sizes of n nearly equal parts of xp pixels
+def split_axis(xp, n):
+    edges = [i * xp // n for i in range(n + 1)]
+    return [(edges[i], edges[i + 1] - edges[i]) for i in range(n)]
+
 
-                cnt = cnt + 1
+# best tiling of each distinct part size, the parts have at most two widths and
+# two heights, None if one of them has no tiling
+def part_tilings(xparts, yparts, maxtiles, maxres, sort_dir, square_ratio):
+    tilings = {}
+    for xsize in set(size for off, size in xparts):
+        for ysize in set(size for off, size in yparts):
+            candidates = plan_tiles(xsize, ysize, maxtiles, maxres, sort_dir, square_ratio)
+            if len(candidates) == 0:
+                return None
+            tilings[(xsize, ysize)] = candidates[0]
 
-    tiles.sort(key=lambda x: sort_dir * x[5])
+    return tilings
+
+
+# fewest parts, a px by py grid of nearly equal windows, that each have a
+# tiling within the limits, returns [(xoff, yoff, xsize, ysize, tiling)] row by
+# row or an empty list if no split of up to maxparts parts fits
+def plan_split(xp, yp, maxtiles, maxres, sort_dir=-1, square_ratio=1.2, maxparts=MAX_PARTS):
+    # a part holds at most maxtiles tiles of less than maxres pixels
+    first = max(2, ceil_div(xp * yp, maxtiles * maxres))
+
+    for n in range(first, maxparts + 1):
+        best = None
+        for px in range(1, n + 1):
+            if n % px != 0 or px > xp or n // px > yp:
+                continue
+            py = n // px
+
+            xparts = split_axis(xp, px)
+            yparts = split_axis(yp, py)
+
+            tilings = part_tilings(xparts, yparts, maxtiles, maxres, sort_dir, square_ratio)
+            if tilings is None:
+                continue
+
+            parts = [(xoff, yoff, xsize, ysize, tilings[(xsize, ysize)])
+                     for yoff, ysize in yparts for xoff, xsize in xparts]
+            # squarest parts first, then fewest tiles
+            aspect = max(xparts[0][1], yparts[0][1]) / min(xparts[0][1], yparts[0][1])
+            rank = (aspect, sum(part[4].ntiles for part in parts))
+            if best is None or rank < best[0]:
+                best = (rank, parts)
+
+        if best is not None:
+            return best[1]
+
+    return []
+
+
+def get_tile_size(filename, maxtiles, maxres, sort_dir, square_ratio):
+    from osgeo import gdal
+
+    src = gdal.Open(filename)
+    tiles = plan_tiles(src.RasterXSize, src.RasterYSize, maxtiles, maxres, sort_dir, square_ratio)
 
     if len(tiles) == 0:
         return None
     else:
         return tiles[0]
+
+
+# tile windows covering a raster, in the order and with the names gdal_retile uses
+def tile_grid(name, xp, yp, xps, yps):
+    nx = xp // xps + (xp % xps > 0)
+    ny = yp // yps + (yp % yps > 0)
+    digits = len(str(max(nx, ny)))
+
+    grid = []
+    for row in range(1, ny + 1):
+        for col in range(1, nx + 1):
+            xoff = (col - 1) * xps
+            yoff = (row - 1) * yps
+            tname = "%s_%0*d_%0*d" % (name, digits, row, digits, col)
+            grid.append((tname, xoff, yoff, min(xps, xp - xoff), min(yps, yp - yoff)))
+
+    return grid
+
+
+# georeferenced bounds (ulx, uly, lrx, lry) of a tile window
+def tile_bounds(gt, xoff, yoff, xsize, ysize):
+    ulx = gt[0] + xoff * gt[1]
+    uly = gt[3] + yoff * gt[5]
+    lrx = ulx + xsize * gt[1]
+    lry = uly + ysize * gt[5]
+
+    return ulx, uly, lrx, lry
+
+
+# read a file from gdal's virtual file system
+def read_vsi(filename):
+    from osgeo import gdal
+
+    size = gdal.VSIStatL(filename).size
+    fh = gdal.VSIFOpenL(filename, "rb")
+    data = gdal.VSIFReadL(1, size, fh)
+    gdal.VSIFCloseL(fh)
+
+    return data
+
+
+# encode a window of a raster to jpeg in memory
+def encode_jpeg(src, xoff, yoff, xsize, ysize, quality):
+    from osgeo import gdal
+
+    mem = "/vsimem/tile_%s.jpg" % uuid.uuid4().hex
+    opt = gdal.TranslateOptions(format="JPEG", srcWin=[xoff, yoff, xsize, ysize],
+                                creationOptions=["QUALITY=%d" % quality])
+    gdal.Translate(mem, src, options=opt)
+    data = read_vsi(mem)
+    gdal.Unlink(mem)
+
+    return data
+
+
+# highest quality at or below quality whose jpeg fits in maxsize bytes, the
+# window is read once into memory and re-encoded while searching, returns
+# (jpeg bytes, quality) with the lowest quality tried if nothing fits
+def fit_jpeg(src, xoff, yoff, xsize, ysize, quality, maxsize):
+    from osgeo import gdal
+
+    data = encode_jpeg(src, xoff, yoff, xsize, ysize, quality)
+    if maxsize is None or len(data) <= maxsize or quality <= 1:
+        return data, quality
+
+    opt = gdal.TranslateOptions(format="MEM", srcWin=[xoff, yoff, xsize, ysize])
+    mem = gdal.Translate("", src, options=opt)
+
+    best = None
+    lo = 1
+    hi = quality - 1
+    while lo <= hi:
+        q = (lo + hi) // 2
+        qdata = encode_jpeg(mem, 0, 0, xsize, ysize, q)
+        if len(qdata) <= maxsize:
+            best = (qdata, q)
+            lo = q + 1
+        else:
+            hi = q - 1
+
+    if best is None:
+        best = (encode_jpeg(mem, 0, 0, xsize, ysize, 1), 1)
+
+    return best
+
+
+# setup of an encoding thread, the jpegs written to /vsimem need no .aux.xml
+# and the option is thread local so other gdal users in the process keep pam
+def init_thread():
+    from osgeo import gdal
+
+    gdal.SetThreadLocalConfigOption("GDAL_PAM_ENABLED", "NO")
+
+
+# encode the tiles of a grid to jpeg, yields (name, jpeg bytes, bounds, quality)
+# in grid order, with maxsize the quality is lowered per tile to fit maxsize bytes
+def gen_tiles(ifile, grid, quality, workers=1, maxsize=None):
+    from osgeo import gdal
+
+    src = gdal.Open(ifile)
+    gt = src.GetGeoTransform()
+    del src
+
+    # datasets are not thread safe, each thread reads through its own handle
+    local = threading.local()
+
+    def encode(tile):
+        if not hasattr(local, "src"):
+            local.src = gdal.Open(ifile)
+        tname, xoff, yoff, xsize, ysize = tile
+
+        return fit_jpeg(local.src, xoff, yoff, xsize, ysize, quality, maxsize)
+
+    # gdal releases the GIL while encoding, only a few tiles are encoded ahead
+    # of the consumer so memory stays bounded
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, initializer=init_thread) as executor:
+        pending = collections.deque()
+        for tile in grid:
+            pending.append((tile, executor.submit(encode, tile)))
+            if len(pending) >= 2 * workers:
+                yield result_tile(gt, *pending.popleft())
+
+        while pending:
+            yield result_tile(gt, *pending.popleft())
+
+
+def result_tile(gt, tile, future):
+    tname, xoff, yoff, xsize, ysize = tile
+    data, quality = future.result()
+    return tname, data, tile_bounds(gt, xoff, yoff, xsize, ysize), quality
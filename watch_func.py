@@ -0,0 +1,187 @@
+import collections
+import datetime
+import importlib
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import batch_func
+
+# seconds between scans of the watched directory
+POLL_INTERVAL = 2.0
+
+# seconds a file's size and modification time must stay unchanged before it is
+# converted, so files still being copied in are left alone
+SETTLE_TIME = 10.0
+
+# free space in MB the temporary directory needs before another conversion starts
+MIN_FREE = 2048
+
+# conversions a worker runs before it is replaced, bounding any memory it leaks
+WORKER_TASKS = 100
+
+# modules a worker loads once when it starts rather than with its first file
+WARM_MODULES = ["numpy", "osgeo.gdal", "osgeo.osr", "map_func", "tile_func", "genkml_func", "genkmz_func",
+                "superoverlay_func", "pdf2kmz"]
+
+
+def init_worker():
+    # the daemon stops the workers itself, they ignore the ctrl-c sent to the group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    for name in WARM_MODULES:
+        importlib.import_module(name)
+
+
+# convert a file in a worker, returns (input, status, output, error, report)
+def convert_file(job):
+    ifile, options = job
+
+    import pdf2kmz
+
+    try:
+        result = pdf2kmz.convert(ifile, options)
+        return ifile, "ok", result.output, None, result.report
+    except pdf2kmz.ConvertError as err:
+        return ifile, "failed", None, str(err), None
+    except Exception as err:
+        return ifile, "failed", None, "%s: %s" % (type(err).__name__, err), None
+
+
+# size and modification time of a file, None once it has gone
+def signature(ifile):
+    try:
+        st = os.stat(ifile)
+    except OSError:
+        return None
+
+    return st.st_size, st.st_mtime
+
+
+# a kmz (or the first part of a split one) at least as new as the input
+def up_to_date(ifile, options):
+    name, ext = os.path.splitext(os.path.basename(ifile))
+    odir = options.outdir or os.path.dirname(os.path.realpath(ifile))
+
+    mtime = os.path.getmtime(ifile)
+    for ofile in (name + ".kmz", name + "_part1.kmz"):
+        ofile = os.path.join(odir, ofile)
+        if os.path.isfile(ofile) and os.path.getmtime(ofile) >= mtime:
+            return True
+
+    return False
+
+
+def free_mb(path):
+    return shutil.disk_usage(path).free // (1024 * 1024)
+
+
+# append an event to the json lines status log, echoed when verbose
+def log_event(slog, verbose, event, **fields):
+    entry = {"time": datetime.datetime.now().isoformat(timespec="seconds"), "event": event}
+    entry.update(fields)
+
+    with open(slog, 'a') as fh:
+        fh.write(json.dumps(entry) + "\n")
+
+    if verbose:
+        print(" ".join("%s=%s" % (k, v) for k, v in entry.items() if v is not None))
+
+
+# watch a directory and convert every pdf or tif that appears in it once it has
+# settled, on a pool of jobs warm workers, until interrupted
+# conversions always overwrite, a file is skipped only when its kmz is at least
+# as new as it is, so a replaced sheet is converted again
+def run_watch(wdir, options, jobs, slog, settle=SETTLE_TIME, min_free=MIN_FREE, poll=POLL_INTERVAL):
+    import multiprocessing
+
+    options = batch_func.worker_options(options._replace(force=True), jobs)
+    verbose = options.verbose
+    tempbase = options.tmpdir or tempfile.gettempdir()
+
+    # files seen changing: signature and when it was first seen
+    settling = {}
+    # signatures of the files converted (or failed) in this run
+    done = {}
+    queue = collections.deque()
+    running = {}
+    waiting = False
+
+    pool = multiprocessing.Pool(jobs, initializer=init_worker, maxtasksperchild=WORKER_TASKS)
+
+    # a terminated daemon stops like an interrupted one
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    log_event(slog, verbose, "watching", directory=os.path.realpath(wdir), workers=jobs)
+
+    try:
+        while True:
+            now = time.monotonic()
+
+            queued = set(ifile for ifile, sig in queue)
+            inputs = batch_func.find_inputs([wdir])
+            for ifile in set(settling) - set(inputs):
+                del settling[ifile]
+
+            for ifile in inputs:
+                sig = signature(ifile)
+                if sig is None or done.get(ifile) == sig or ifile in running or ifile in queued:
+                    continue
+
+                seen = settling.get(ifile)
+                if seen is None or seen[0] != sig:
+                    settling[ifile] = (sig, now)
+                elif now - seen[1] >= settle:
+                    del settling[ifile]
+                    if up_to_date(ifile, options):
+                        done[ifile] = sig
+                        continue
+
+                    queue.append((ifile, sig))
+                    log_event(slog, verbose, "queued", input=ifile)
+
+            for ifile, (sig, res) in list(running.items()):
+                if not res.ready():
+                    continue
+                del running[ifile]
+                done[ifile] = sig
+
+                ifile, status, output, error, report = res.get()
+                if report is not None:
+                    log_event(slog, verbose, status, input=ifile, output=output, wall=report.get("wall"),
+                              tiles=report.get("tiles"), kmz_bytes=report.get("kmz_bytes"))
+                else:
+                    log_event(slog, verbose, status, input=ifile, error=error)
+
+            while queue and len(running) < jobs:
+                # backpressure, nothing new starts while the temporary disk is short
+                free = free_mb(tempbase)
+                if free < min_free:
+                    if not waiting:
+                        log_event(slog, verbose, "waiting", free_mb=free, queued=len(queue))
+                        waiting = True
+                    break
+                waiting = False
+
+                ifile, sig = queue.popleft()
+                if signature(ifile) != sig:
+                    # changed again (or gone) while queued, it has to settle again
+                    continue
+
+                running[ifile] = (sig, pool.apply_async(convert_file, ((ifile, options),)))
+                log_event(slog, verbose, "started", input=ifile)
+
+            time.sleep(poll)
+    except (KeyboardInterrupt, SystemExit):
+        log_event(slog, verbose, "stopped", queued=len(queue), interrupted=sorted(running))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return 0